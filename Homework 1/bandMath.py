@@ -0,0 +1,112 @@
+import ast
+import threading
+import numpy as np
+
+# Simple band math engine shared by the scripts that compute spectral indices
+#   Indices are declared once as expressions over named bands (e.g. "(g - s1) / (g + s1)") and compiled into a short
+#   list of NumPy operations that evaluates any number of indices in one pass over a block
+#   Subexpressions shared between indices (e.g. "b + s1") are computed once, every intermediate is written into a
+#   preallocated buffer that is reused for every block of the same shape, and arithmetic is done in float64 so uint16
+#   bands can produce negative values
+
+# Sentinel-2 bands of the Spatially Aligned scenes
+#  [red, green, blue, nir, swir1, swir2, alpha]
+sentinelBands = {"r": 0, "g": 1, "b": 2, "n": 3, "s1": 4, "s2": 5, "a": 6}
+
+# Supported operators
+operators = {ast.Add: np.add, ast.Sub: np.subtract, ast.Mult: np.multiply, ast.Div: np.divide}
+
+
+# Function to compile expressions into a program
+#   expressions: index name -> expression
+#   bands: band name -> position of the band in the blocks
+#   constants: optional constant name -> value (e.g. {"eps": sys.float_info.epsilon})
+#   Operands are ("band", position), ("constant", value) or ("step", step number)
+def compileIndices(expressions, bands, constants=None):
+    constants = {} if constants is None else constants
+    steps = []
+    known = {}
+
+    def visit(node):
+        if isinstance(node, ast.BinOp) and type(node.op) in operators:
+            key = (type(node.op), visit(node.left), visit(node.right))
+            if key not in known:
+                steps.append(key)
+                known[key] = ("step", len(steps) - 1)
+            return known[key]
+        if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+            return visit(ast.BinOp(ast.Constant(0), ast.Sub(), node.operand))
+        if isinstance(node, ast.Name) and node.id in bands:
+            return "band", bands[node.id]
+        if isinstance(node, ast.Name) and node.id in constants:
+            return "constant", float(constants[node.id])
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)):
+            return "constant", float(node.value)
+        raise ValueError("Unsupported band math: " + ast.unparse(node))
+
+    outputs = [visit(ast.parse(expression, mode='eval').body) for expression in expressions.values()]
+
+    # Assign every step a buffer, freeing the buffers of intermediates after their last use
+    #   Steps that are outputs are written straight into the output array instead
+    lastUse = {}
+    for i, (_, left, right) in enumerate(steps):
+        for operand in (left, right):
+            if operand[0] == "step":
+                lastUse[operand[1]] = i
+    destinations = {}
+    for k, output in enumerate(outputs):
+        if output[0] == "step" and output[1] not in destinations:
+            destinations[output[1]] = ("output", k)
+    free = []
+    buffers = 0
+    for i, (_, left, right) in enumerate(steps):
+        for operand in {left, right}:
+            if operand[0] == "step" and lastUse[operand[1]] == i and destinations[operand[1]][0] == "buffer":
+                free.append(destinations[operand[1]][1])
+        if i not in destinations:
+            if not free:
+                free.append(buffers)
+                buffers += 1
+            destinations[i] = ("buffer", free.pop())
+
+    return {"names": list(expressions), "steps": steps, "outputs": outputs, "destinations": destinations,
+            "buffers": buffers, "scratch": {}}
+
+
+# Function to evaluate a compiled program over a block
+#   block: bands along axis (the remaining axes are the block shape)
+#   out: optional output array [index, *block shape] (a new float64 array otherwise)
+#   Returns the output array, with the indices in the order they were declared
+def evaluateIndices(program, block, axis=0, out=None):
+    shape = block.shape[:axis] + block.shape[axis + 1:]
+    if out is None:
+        out = np.empty((len(program["names"]),) + shape)
+    # Buffers are per thread, so readers running in parallel threads (e.g. tf.data) never share them
+    key = (threading.get_ident(), shape)
+    if key not in program["scratch"]:
+        program["scratch"][key] = [np.empty(shape) for _ in range(program["buffers"])]
+    scratch = program["scratch"][key]
+    values = {}
+
+    def value(operand):
+        if operand[0] == "band":
+            return block[(slice(None),) * axis + (operand[1],)]
+        if operand[0] == "constant":
+            return operand[1]
+        return values[operand[1]]
+
+    # Zero sums give NaN/inf, as the hand-written ratios did
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for i, (operator, left, right) in enumerate(program["steps"]):
+            kind, position = program["destinations"][i]
+            destination = out[position] if kind == "output" else scratch[position]
+            values[i] = operators[operator](value(left), value(right), out=destination, dtype=np.float64)
+        for k, output in enumerate(program["outputs"]):
+            if output[0] != "step" or program["destinations"][output[1]] != ("output", k):
+                out[k] = value(output)
+    return out
+
+
+# Function to evaluate a compiled program over a block -> index name -> values
+def evaluateIndexDict(program, block, axis=0):
+    return dict(zip(program["names"], evaluateIndices(program, block, axis)))
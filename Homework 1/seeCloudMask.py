@@ -1,63 +1,119 @@
 import os
 import sys
+import concurrent.futures
 import numpy as np
 from osgeo import gdal
+import bandMath
 
 # Simple script to merge alpha and cloud mask layers to visualise cloud mask in QGIS
+#   Scenes are processed in parallel, one block of rows at a time, and each block is written as soon as it is masked
 
 # Defining relative PATHs
 GeoTIF_dir = "s2_santafe_spatially_aligned"
 masked_dir = "cloud_masked"
 
-images = []
-labels = []
-geoTransform = None
-projection = None
-print("Adding Cloud Mask...")
-for GeoTIF in os.listdir(GeoTIF_dir):
-    labels.append(GeoTIF)
-    dataset = gdal.Open(GeoTIF_dir + '\\' + GeoTIF)
-    geoTransform = dataset.GetGeoTransform()
-    projection = dataset.GetProjection()
-    image = dataset.ReadAsArray()
-    bands, height, width = image.shape
-    newImage = np.full((bands + 1, height, width), 65535)
-    NDSI = np.zeros((height, width))
-    ratio1 = np.zeros((height, width))
-    ratio2 = np.zeros((height, width))
-    newImage[:bands, :, :] = image
-    for j in range(height):
-        for k in range(width):
-            if newImage[6, j, k] > 0:
-                NDSI[j, k] = (newImage[1, j, k] - newImage[4, j, k]) / (newImage[1, j, k] + newImage[4, j, k])
-                ratio1[j, k] = (newImage[2, j, k] - newImage[4, j, k]) / (newImage[2, j, k] + newImage[4, j, k])
-                ratio2[j, k] = (newImage[2, j, k] - newImage[5, j, k]) / (newImage[2, j, k] + newImage[5, j, k])
-                if -.13 <= ratio1[j, k] and -.13 <= ratio2[j, k] and NDSI[j, k] <= .4:
-                    newImage[7, j, k] = 0
-    images.append(newImage)
-
-for image in images:
-    _, height, width = image.shape
-    for j in range(height):
-        for k in range(width):
-            image[6, j, k] = min(image[6, j, k], image[7, j, k])
-
-try:
-    os.mkdir(masked_dir)
-except:
-    sys.exit("Cloud Masked Data already exists")
-
-print("Creating GeoTIFFs...")
-for image, name in zip(images, labels):
-    bands, height, width = image.shape
-    bands -= 1
+
+# Cloud mask indices, evaluated in one pass per block (see bandMath)
+cloudIndices = bandMath.compileIndices({
+    "NDSI": "(g - s1) / (g + s1)",
+    "ratio1": "(b - s1) / (b + s1)",
+    "ratio2": "(b - s2) / (b + s2)",
+}, bandMath.sentinelBands)
+
+
+# Function to create the cloud mask of a block of a scene (only within alpha-valid pixels)
+#  [red, green, blue, nir, swir1, swir2, alpha]
+def cloudMask(image):
+    NDSI, ratio1, ratio2 = bandMath.evaluateIndices(cloudIndices, image)
+    return (image[6] > 0) & (-.13 <= ratio1) & (-.13 <= ratio2) & (NDSI <= .4)
+
+
+# Function to write a copy of a scene with its cloud mask merged into the alpha band (run in worker processes)
+def maskScene(srcFile, destFile, blockRows=256):
+    dataset = gdal.Open(srcFile)
+    width = dataset.RasterXSize
+    height = dataset.RasterYSize
+    bands = dataset.RasterCount
+    driver = gdal.GetDriverByName('GTiff')
+    tif = driver.Create(destFile, width, height, bands, gdal.GDT_UInt16)
+    tif.SetGeoTransform(dataset.GetGeoTransform())
+    tif.SetProjection(dataset.GetProjection())
+    for start in range(0, height, blockRows):
+        rows = min(blockRows, height - start)
+        image = dataset.ReadAsArray(0, start, width, rows)
+        # Cloudy pixels become transparent
+        image[6][cloudMask(image)] = 0
+        for band in range(bands):
+            tif.GetRasterBand(band + 1).WriteArray(image[band, :, :], 0, start)
+    tif.FlushCache()
+    tif = None
+    return destFile
+
+
+# Per-dataset mask band of a VRT, read from a 1-bit mask file (0/1 scaled to GDAL's 0 = masked, 255 = valid)
+mask_band_vrt = """  <MaskBand>
+    <VRTRasterBand dataType="Byte">
+      <ComplexSource>
+        <SourceFilename relativeToVRT="1">{}</SourceFilename>
+        <SourceBand>1</SourceBand>
+        <ScaleRatio>255</ScaleRatio>
+      </ComplexSource>
+    </VRTRasterBand>
+  </MaskBand>
+"""
+
+
+# Function to write a scene's merged alpha/cloud mask as a 1-bit mask file, plus a VRT referencing the original bands
+# that uses it as its mask band (run in worker processes)
+#   No pixel data is duplicated, so the output is roughly the band count (x16 bits) smaller than a masked copy
+def maskSidecar(srcFile, vrtFile, blockRows=256):
+    maskFile = os.path.splitext(vrtFile)[0] + ".msk.tif"
+    dataset = gdal.Open(srcFile)
+    width = dataset.RasterXSize
+    height = dataset.RasterYSize
     driver = gdal.GetDriverByName('GTiff')
-    tif = driver.Create(masked_dir + '\\' + name, width, height, bands, gdal.GDT_UInt16)
-    tif.SetGeoTransform(geoTransform)
-    tif.SetProjection(projection)
-    for band in range(bands):
-        tif.GetRasterBand(band + 1).WriteArray(image[band, :, :])
+    tif = driver.Create(maskFile, width, height, 1, gdal.GDT_Byte,
+                        options=['NBITS=1', 'COMPRESS=DEFLATE', 'TILED=YES'])
+    tif.SetGeoTransform(dataset.GetGeoTransform())
+    tif.SetProjection(dataset.GetProjection())
+    for start in range(0, height, blockRows):
+        rows = min(blockRows, height - start)
+        image = dataset.ReadAsArray(0, start, width, rows)
+        # Valid pixels are alpha-valid and cloudless
+        valid = (image[6] > 0) & ~cloudMask(image)
+        tif.GetRasterBand(1).WriteArray(valid.astype(np.uint8), 0, start)
     tif.FlushCache()
     tif = None
 
-print("Done")
\ No newline at end of file
+    gdal.Translate(vrtFile, os.path.abspath(srcFile), format='VRT')
+    with open(vrtFile) as file:
+        vrt = file.read()
+    vrt = vrt.replace("</VRTDataset>", mask_band_vrt.format(os.path.basename(maskFile)) + "</VRTDataset>")
+    with open(vrtFile, 'w') as file:
+        file.write(vrt)
+    return vrtFile
+
+
+if __name__ == "__main__":
+    try:
+        os.mkdir(masked_dir)
+    except:
+        sys.exit("Cloud Masked Data already exists")
+
+    print("Adding Cloud Mask...")
+    # Only the scenes, GeoTIFFs or VRTs (task_1 --vrt), skipping e.g. .ovr/.aux.xml files GDAL may have left
+    GeoTIFs = [GeoTIF for GeoTIF in os.listdir(GeoTIF_dir) if GeoTIF.lower().endswith((".tif", ".tiff", ".vrt"))]
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        # Only write 1-bit masks and VRTs referencing the original scenes
+        if "--sidecar" in sys.argv:
+            futures = [executor.submit(maskSidecar, os.path.join(GeoTIF_dir, GeoTIF),
+                                       os.path.join(masked_dir, os.path.splitext(GeoTIF)[0] + ".vrt"))
+                       for GeoTIF in GeoTIFs]
+        else:
+            futures = [executor.submit(maskScene, os.path.join(GeoTIF_dir, GeoTIF),
+                                       os.path.join(masked_dir, os.path.splitext(GeoTIF)[0] + ".tif"))
+                       for GeoTIF in GeoTIFs]
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
+    print("Done")
@@ -1,7 +1,11 @@
 import os
+import re
 import sys
 import json
-import shutil
+import math
+import bisect
+import hashlib
+import concurrent.futures
 from osgeo import gdal
 
 ## Mark Koszykowski
@@ -9,76 +13,372 @@ from osgeo import gdal
 ## Homework 1 - Problem 1 Task 1
 
 # Defining relative PATHs
-temp_dir = "tmp"
 GeoTIF_dir = "s2_santafe"
 align_dir = GeoTIF_dir + "_spatially_aligned"
+index_file = GeoTIF_dir + "_index.json"
+manifest_file = align_dir + "_manifest.json"
 GeoJSON = "santafe_crop.geojson"
 
 
+# Function to extract min/max square dimensions of a GeoJSON Polygon/MultiPolygon geometry (all rings)
+def getGeometryBounds(geometry):
+    polygons = [geometry['coordinates']] if geometry['type'] == 'Polygon' else geometry['coordinates']
+
+    lat = []
+    long = []
+
+    for polygon in polygons:
+        for ring in polygon:
+            for e in ring:
+                long.append(e[0])
+                lat.append(e[1])
+
+    # Return the min/max box coordinates
+    return min(long), min(lat), max(long), max(lat)
+
+
 # Function to extract min/max square dimensions from JSON
 def getOutputBounds(path):
     with open(path) as jsonFile:
         data = json.load(jsonFile)
         vector = data['features'][0]['geometry']
 
-    lat = []
-    long = []
+    return getGeometryBounds(vector)
 
-    for e in vector['coordinates'][0]:
-        long.append(e[0])
-        lat.append(e[1])
 
-    # Return the min/max box coordinates
-    return min(long), min(lat), max(long), max(lat)
+# Function to extract every Polygon/MultiPolygon AOI of a FeatureCollection as (name, min/max square dimensions)
+#   AOIs are named after their "name"/"id" property, or their position in the collection
+#   Names are used as directory names, so anything but letters, digits, "_", "-" and "." (e.g. path separators) is
+#   replaced by "_", leading dots are dropped (no "..") and a name already taken gets the feature's position appended
+def getAOIs(path):
+    with open(path) as jsonFile:
+        data = json.load(jsonFile)
+
+    aois = []
+    taken = set()
+    for i, feature in enumerate(data['features']):
+        if feature['geometry']['type'] not in ('Polygon', 'MultiPolygon'):
+            continue
+        properties = feature.get('properties') or {}
+        name = str(properties.get('name', properties.get('id', feature.get('id', i))))
+        name = re.sub(r"[^\w.-]", "_", name).lstrip(".") or str(i)
+        # Compared case-insensitively, as directories are on Windows/macOS
+        while name.lower() in taken:
+            name += "_" + str(i)
+        taken.add(name.lower())
+        aois.append((name, getGeometryBounds(feature['geometry'])))
+    return aois
+
+
+# Function to build a spatial index of AOIs (sorted by min longitude, so a query only scans AOIs that start before
+# the query ends)
+def buildAOIIndex(aois):
+    aois = sorted(aois, key=lambda aoi: aoi[1][0])
+    return [bounds[0] for _, bounds in aois], aois
+
+
+# Function to find the AOIs intersecting some bounds
+def queryAOIIndex(aoiIndex, bounds):
+    minLongs, aois = aoiIndex
+    minX, minY, maxX, maxY = bounds
+    return [(name, aoi) for name, aoi in aois[:bisect.bisect_right(minLongs, maxX)]
+            if aoi[2] >= minX and aoi[1] <= maxY and aoi[3] >= minY]
+
+
+# Function to read the metadata of a GeoTIFF from its header (no pixel data is read)
+def readHeader(path):
+    dataset = gdal.Open(path)
+    xOrigin, xRes, _, yOrigin, _, yRes = dataset.GetGeoTransform()
+    width = dataset.RasterXSize
+    height = dataset.RasterYSize
+    band = dataset.GetRasterBand(1)
+    stat = os.stat(path)
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime,
+        "xRes": xRes,
+        "yRes": yRes,
+        "bounds": [xOrigin, yOrigin + yRes * height, xOrigin + xRes * width, yOrigin],
+        "width": width,
+        "height": height,
+        "crs": dataset.GetProjection(),
+        "bands": dataset.RasterCount,
+        "dtype": gdal.GetDataTypeName(band.DataType),
+        "nodata": band.GetNoDataValue(),
+        # Resolutions once warped to EPSG:4326, cached per set of output bounds
+        "warped": {},
+    }
+
+
+# Function to build a metadata index (file name -> header metadata) of a directory
+#   If an index file is given, it is loaded and only files whose size/mtime changed are re-read
+def buildIndex(path, indexFile=None):
+    index = {}
+    if indexFile is not None and os.path.exists(indexFile):
+        with open(indexFile) as jsonFile:
+            index = json.load(jsonFile)
+
+    newIndex = {}
+    for GeoTIF in sorted(os.listdir(path)):
+        stat = os.stat(os.path.join(path, GeoTIF))
+        entry = index.get(GeoTIF)
+        if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime:
+            entry = readHeader(os.path.join(path, GeoTIF))
+        newIndex[GeoTIF] = entry
+    return newIndex
+
+
+# Function to write a JSON file through a temporary file that then replaces it, so an interrupted run never leaves a
+# partially written file behind
+def writeJson(file, data):
+    tmpFile = file + ".tmp"
+    with open(tmpFile, 'w') as jsonFile:
+        json.dump(data, jsonFile, indent=1)
+    os.replace(tmpFile, file)
+
+
+# Function to save a metadata index next to the data
+def saveIndex(index, indexFile):
+    writeJson(indexFile, index)
+
+
+# Function to get the name of an aligned file in the output format (GTiff -> .tif as the source, VRT -> .vrt)
+def outputName(GeoTIF, outputFormat):
+    return os.path.splitext(GeoTIF)[0] + ".vrt" if outputFormat == 'VRT' else GeoTIF
 
 
 # Function to crop dataset to certain bounds (projecting to EPSG:4326)
-def cropData(srcPath, destPath, outputBounds):
+#   The cropped files are in-memory virtual rasters (VRT), so no intermediate pixels are written to disk
+def cropData(srcPath, outputBounds):
     print("Cropping dataset...")
+    crops = {}
     for GeoTIF in os.listdir(srcPath):
-        gdal.Warp(destPath + '\\' + GeoTIF, srcPath + '\\' + GeoTIF,
-                  outputBounds=outputBounds, dstSRS='EPSG:4326')
+        crops[GeoTIF] = gdal.Warp('', os.path.join(srcPath, GeoTIF), format='VRT',
+                                  outputBounds=outputBounds, dstSRS='EPSG:4326')
+    return crops
 
 
 # Function to ensure whole dataset has same resolution
-def normData(srcPath, destPath):
+#   crops: file name -> cropped dataset
+def normData(crops, destPath, outputFormat='GTiff'):
     print("Resampling dataset...")
     xResList = []
     yResList = []
 
     # Retrieve resolutions of each image
-    for GeoTIF in os.listdir(srcPath):
-        dataset = gdal.Open(srcPath + '\\' + GeoTIF)
+    for dataset in crops.values():
         _, xRes, _, _, _, yRes = dataset.GetGeoTransform()
         xResList.append(xRes)
         yResList.append(yRes)
 
     # xRes are positive
     # yRes are negative
-    for GeoTIF in os.listdir(srcPath):
-        gdal.Warp(destPath + '\\' + GeoTIF, srcPath + '\\' + GeoTIF,
+    for GeoTIF, dataset in crops.items():
+        gdal.Warp(os.path.join(destPath, outputName(GeoTIF, outputFormat)), dataset, format=outputFormat,
                   xRes=max(xResList), yRes=min(yResList), resampleAlg=gdal.GRA_Bilinear)
 
 
+# Function to write the aligned dataset as a single multi-file VRT stack (each file's bands one after another)
+#   Needs GDAL 3.8+ for the separate bands of multi-band files to all be kept
+def buildStackVRT(path, stackFile):
+    files = [os.path.join(path, GeoTIF) for GeoTIF in sorted(os.listdir(path))]
+    gdal.BuildVRT(stackFile, files, separate=True)
+
+
+# Function to compute the resolution of the aligned dataset from the metadata index
+#   Each file's resolution once cropped and projected to EPSG:4326 is read from a virtual (VRT) warp, which computes
+#   the output geotransform without reading any pixels, and is cached in the index for these output bounds
+def getTargetResolution(srcPath, index, outputBounds):
+    key = json.dumps(outputBounds)
+    xResList = []
+    yResList = []
+    for GeoTIF, entry in index.items():
+        if key not in entry["warped"]:
+            dataset = gdal.Warp('', os.path.join(srcPath, GeoTIF), format='VRT',
+                                outputBounds=outputBounds, dstSRS='EPSG:4326')
+            _, xRes, _, _, _, yRes = dataset.GetGeoTransform()
+            entry["warped"][key] = [xRes, yRes]
+        xRes, yRes = entry["warped"][key]
+        xResList.append(xRes)
+        yResList.append(yRes)
+
+    # xRes are positive
+    # yRes are negative
+    return max(xResList), min(yResList)
+
+
+# Function to hash the content of a file, cached in its index entry (entries are re-read whenever the file changes)
+def fileHash(path, entry):
+    if "sha256" not in entry:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as file:
+            for chunk in iter(lambda: file.read(1 << 20), b''):
+                digest.update(chunk)
+        entry["sha256"] = digest.hexdigest()
+    return entry["sha256"]
+
+
+# Function to compute the key of an aligned file from everything its pixels depend on
+def alignKey(sourceHash, outputBounds, dstSRS, xRes, yRes, resampleAlg, outputFormat):
+    key = json.dumps([sourceHash, list(outputBounds), dstSRS, xRes, yRes, resampleAlg, outputFormat])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+# Function to crop, project and resample one file onto the target grid in a single warp (run in worker processes)
+#   The warp is written to a .part file and renamed when complete, so an interrupted run never leaves a partial output
+#   outputFormat='VRT' writes a virtual warped raster that references the source instead of any pixels
+def alignFile(srcFile, destFile, outputBounds, xRes, yRes, dstSRS='EPSG:4326', resampleAlg='bilinear',
+              outputFormat='GTiff'):
+    gdal.Warp(destFile + ".part", os.path.abspath(srcFile), format=outputFormat, outputBounds=outputBounds,
+              dstSRS=dstSRS, xRes=xRes, yRes=abs(yRes), resampleAlg=resampleAlg)
+    os.replace(destFile + ".part", destFile)
+    return destFile
+
+
+# Function to spatially align the dataset in one pass (no tmp directory), with files warped in parallel
+#   The target grid (bounds and coarsest resolution) is computed up front from the metadata index (cached in
+#   indexFile if given), so every file lands on exactly the same grid
+#   If a manifest file is given, alignment is incremental and resumable: each aligned file is recorded with its key
+#   (source content, bounds, SRS, resolution, resampling) as soon as it is written, and only files whose key changed
+#   (or that are missing) are warped again
+def alignData(srcPath, destPath, outputBounds, indexFile=None, manifestFile=None, workers=None,
+              dstSRS='EPSG:4326', resampleAlg='bilinear', outputFormat='GTiff'):
+    print("Aligning dataset...")
+    index = buildIndex(srcPath, indexFile)
+    xRes, yRes = getTargetResolution(srcPath, index, outputBounds)
+
+    manifest = {}
+    if manifestFile is not None:
+        if os.path.exists(manifestFile):
+            with open(manifestFile) as jsonFile:
+                manifest = json.load(jsonFile)
+        keys = {GeoTIF: alignKey(fileHash(os.path.join(srcPath, GeoTIF), entry), outputBounds, dstSRS, xRes, yRes,
+                                 resampleAlg, outputFormat) for GeoTIF, entry in index.items()}
+    else:
+        keys = {GeoTIF: None for GeoTIF in index}
+    if indexFile is not None:
+        saveIndex(index, indexFile)
+
+    # Remove leftovers of an interrupted run, and outputs whose source no longer exists (or has a new output name)
+    for GeoTIF in os.listdir(destPath):
+        if GeoTIF.endswith(".part"):
+            os.remove(os.path.join(destPath, GeoTIF))
+    for GeoTIF in list(manifest):
+        if GeoTIF not in index or manifest[GeoTIF] != keys[GeoTIF]:
+            for name in {GeoTIF, outputName(GeoTIF, 'VRT')}:
+                if os.path.exists(os.path.join(destPath, name)):
+                    os.remove(os.path.join(destPath, name))
+            del manifest[GeoTIF]
+
+    todo = [GeoTIF for GeoTIF in index if keys[GeoTIF] is None or manifest.get(GeoTIF) != keys[GeoTIF]
+            or not os.path.exists(os.path.join(destPath, outputName(GeoTIF, outputFormat)))]
+    print(F"Warping {len(todo)} of {len(index)} files...")
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(alignFile, os.path.join(srcPath, GeoTIF),
+                                   os.path.join(destPath, outputName(GeoTIF, outputFormat)),
+                                   outputBounds, xRes, yRes, dstSRS, resampleAlg, outputFormat): GeoTIF
+                   for GeoTIF in todo}
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+            if manifestFile is not None:
+                manifest[futures[future]] = keys[futures[future]]
+                writeJson(manifestFile, manifest)
+
+
+# Function to get the EPSG:4326 resolution and bounds of a whole scene from a virtual (VRT) warp (no pixels are read)
+#   Cached in the scene's index entry as [xRes, yRes, minX, minY, maxX, maxY]
+def getSceneGrid(srcPath, GeoTIF, entry):
+    if "scene" not in entry["warped"]:
+        dataset = gdal.Warp('', os.path.join(srcPath, GeoTIF), format='VRT', dstSRS='EPSG:4326')
+        xOrigin, xRes, _, yOrigin, _, yRes = dataset.GetGeoTransform()
+        entry["warped"]["scene"] = [xRes, yRes, xOrigin, yOrigin + yRes * dataset.RasterYSize,
+                                    xOrigin + xRes * dataset.RasterXSize, yOrigin]
+    return entry["warped"]["scene"]
+
+
+# Function to snap bounds outwards onto a global grid of the given resolution, so crops of the same AOI from
+# different scenes (or different reads) all line up
+def snapBounds(bounds, xRes, yRes):
+    minX, minY, maxX, maxY = bounds
+    yRes = abs(yRes)
+    return (math.floor(minX / xRes) * xRes, math.floor(minY / yRes) * yRes,
+            math.ceil(maxX / xRes) * xRes, math.ceil(maxY / yRes) * yRes)
+
+
+# Function to crop every intersecting AOI out of one scene (run in worker processes)
+#   The scene is opened and warped once, into a virtual (VRT) raster covering all of the AOIs, and each AOI is then cut
+#   out of that raster
+#   Only the pixels of the AOI being cut are warped, so a worker never holds more than one AOI in memory (the union of
+#   spread-out AOIs can be close to a whole scene)
+def cropSceneAOIs(srcFile, GeoTIF, destPath, aois, xRes, yRes):
+    snapped = [snapBounds(bounds, xRes, yRes) for _, bounds in aois]
+    union = (min(b[0] for b in snapped), min(b[1] for b in snapped), max(b[2] for b in snapped),
+             max(b[3] for b in snapped))
+    warped = gdal.Warp('', srcFile, format='VRT', outputBounds=union, dstSRS='EPSG:4326',
+                       xRes=xRes, yRes=abs(yRes), resampleAlg='bilinear')
+    for (name, _), (minX, minY, maxX, maxY) in zip(aois, snapped):
+        gdal.Translate(os.path.join(destPath, name, GeoTIF), warped, projWin=[minX, maxY, maxX, minY])
+    return GeoTIF
+
+
+# Function to spatially align the dataset for many AOIs at once, writing one aligned stack per AOI (destPath/name)
+#   Each scene is read once for all the AOIs it intersects, with scenes processed in parallel
+def alignAOIs(srcPath, destPath, aois, indexFile=None, workers=None):
+    print(F"Aligning dataset for {len(aois)} AOIs...")
+    index = buildIndex(srcPath, indexFile)
+    grids = {GeoTIF: getSceneGrid(srcPath, GeoTIF, entry) for GeoTIF, entry in index.items()}
+    if indexFile is not None:
+        saveIndex(index, indexFile)
+
+    # xRes are positive
+    # yRes are negative
+    xRes = max(grid[0] for grid in grids.values())
+    yRes = min(grid[1] for grid in grids.values())
+
+    for name, _ in aois:
+        os.makedirs(os.path.join(destPath, name), exist_ok=True)
+
+    aoiIndex = buildAOIIndex(aois)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = []
+        for GeoTIF, grid in grids.items():
+            intersecting = queryAOIIndex(aoiIndex, grid[2:])
+            if intersecting:
+                futures.append(executor.submit(cropSceneAOIs, os.path.join(srcPath, GeoTIF), GeoTIF, destPath,
+                                               intersecting, xRes, yRes))
+        for future in concurrent.futures.as_completed(futures):
+            future.result()
+
+
 # Main execution to complete task 1
 if __name__ == "__main__":
     print("Creating Spatially Aligned data...")
 
-    # Create necessary directories
-    try:
-        os.mkdir(align_dir)
-        os.mkdir(temp_dir)
-    except:
-        sys.exit("Spatially Aligned data already exists")
-
     outputBounds = getOutputBounds(GeoJSON)
-    cropData(GeoTIF_dir, temp_dir, outputBounds)
-    normData(temp_dir, align_dir)
 
-    # Remove /tmp directory
-    try:
-        shutil.rmtree(temp_dir)
-    except:
-        sys.exit("Failed to delete /tmp directory")
+    # Aligned files as virtual rasters (VRT) referencing the original data, plus a single VRT stack of all of them
+    #   (not for multiple AOIs, which are cropped out of virtual warps that are never written to disk)
+    outputFormat = 'VRT' if "--vrt" in sys.argv and "--multi-aoi" not in sys.argv else 'GTiff'
+
+    # One aligned stack per AOI of the GeoJSON (align_dir/<AOI name>)
+    if "--multi-aoi" in sys.argv:
+        alignAOIs(GeoTIF_dir, align_dir, getAOIs(GeoJSON), index_file)
+    # Original two stage pipeline (crop, then resample), with the cropped data kept in memory
+    elif "--two-stage" in sys.argv:
+        # Create necessary directory
+        try:
+            os.mkdir(align_dir)
+        except:
+            sys.exit("Spatially Aligned data already exists")
+
+        normData(cropData(GeoTIF_dir, outputBounds), align_dir, outputFormat)
+    else:
+        # Existing Spatially Aligned data is updated with new/changed files only
+        os.makedirs(align_dir, exist_ok=True)
+        alignData(GeoTIF_dir, align_dir, outputBounds, index_file, manifest_file, outputFormat=outputFormat)
+
+    if outputFormat == 'VRT':
+        buildStackVRT(align_dir, align_dir + ".vrt")
 
-    print("Done.")
\ No newline at end of file
+    print("Done.")
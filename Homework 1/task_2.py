@@ -1,8 +1,16 @@
 import os
+import re
 import sys
+import json
+import shutil
+import hashlib
+import uuid
+import functools
+import collections
+import concurrent.futures
 import numpy as np
-import matplotlib.pyplot as plt
 from osgeo import gdal
+import bandMath
 
 ## Mark Koszykowski
 ## ECE472 - Remote Sensing
@@ -10,324 +18,1206 @@ from osgeo import gdal
 
 # Defining relative PATHs
 GeoTIF_dir = "s2_santafe_spatially_aligned"
+cube_dir = GeoTIF_dir + "_cube"
+overview_dir = GeoTIF_dir + "_overviews"
 composites_dir = "composites"
 
 
-# Function that loads Spatially Aligned data into a list of numpy arrays for manipulation
-def loadImages(path):
-    images = []
-    labels = []
-    geoTransform = None
-    projection = None
-    for GeoTIF in os.listdir(path):
-        labels.append(path + '\\' + GeoTIF)
-        dataset = gdal.Open(path + '\\' + GeoTIF)
-        geoTransform = dataset.GetGeoTransform()
-        projection = dataset.GetProjection()
-        img = dataset.ReadAsArray()
-        images.append(img)
+# Function to write a JSON file through a temporary file that then replaces it, so an interrupted run never leaves a
+# partially written file behind
+def writeJson(file, data):
+    tmpFile = file + ".tmp"
+    with open(tmpFile, 'w') as jsonFile:
+        json.dump(data, jsonFile)
+    os.replace(tmpFile, file)
 
-    return images, labels, geoTransform, projection
 
+# Function to build an on-disk temporal cube from the Spatially Aligned data
+#   scenes.dat: raw (scene, band, height, width) array, scenes are appended one at a time so memory use stays at one
+#               scene and each (scene, band) plane is a contiguous chunk that row blocks can be read from lazily
+#   cube.json: labels of the scenes in the cube with their file's size and modification time, a build id, array
+#              shape/dtype, and georeferencing
+#   Re-running only appends scenes that are not already in the cube
+#   If a scene in the cube was rewritten (e.g. re-warped by task_1) or removed, the cube and its cloud mask are rebuilt
+#   under a new build id, which the composite state checks before folding (see updateComposites)
+def buildCube(path, cubePath):
+    os.makedirs(cubePath, exist_ok=True)
+    metaFile = os.path.join(cubePath, "cube.json")
+    meta = None
+    if os.path.exists(metaFile):
+        with open(metaFile) as jsonFile:
+            meta = json.load(jsonFile)
+        stale = [label for label in meta["labels"] if sceneStamp(label) != meta.get("sources", {}).get(label)]
+        if stale:
+            print("Rebuilding Cube, changed or removed scenes: " + ", ".join(stale))
+            for name in ("scenes.dat", "clouds.dat", "clouds.json"):
+                if os.path.exists(os.path.join(cubePath, name)):
+                    os.remove(os.path.join(cubePath, name))
+            meta = None
+    if meta is None:
+        meta = {"labels": [], "sources": {}, "build": uuid.uuid4().hex, "shape": None, "dtype": None,
+                "geoTransform": None, "projection": None}
 
-# Function to plot histograms of data over time
-def createHistogram(data):
-    print("Creating Histograms...")
-    bands, height, width = data[0].shape
-    bands -= 1
+    sceneBytes = 0 if meta["shape"] is None else int(np.prod(meta["shape"])) * np.dtype(meta["dtype"]).itemsize
+    with open(os.path.join(cubePath, "scenes.dat"), 'ab') as sceneFile:
+        # Drop the bytes of a scene that was written but never recorded in the metadata (an interrupted build)
+        sceneFile.truncate(len(meta["labels"]) * sceneBytes)
+        for GeoTIF in sorted(os.listdir(path)):
+            label = os.path.join(path, GeoTIF)
+            # Scenes are GeoTIFFs, or VRTs referencing the original data (task_1 --vrt)
+            if label in meta["labels"] or not GeoTIF.lower().endswith((".tif", ".tiff", ".vrt")):
+                continue
+            stamp = sceneStamp(label)
+            dataset = gdal.Open(label)
+            img = dataset.ReadAsArray()
+            if meta["shape"] is None:
+                meta["shape"] = list(img.shape)
+                meta["dtype"] = img.dtype.name
+                meta["geoTransform"] = dataset.GetGeoTransform()
+                meta["projection"] = dataset.GetProjection()
+                sceneBytes = img.nbytes
+            elif list(img.shape) != meta["shape"]:
+                sys.exit(label + " is not Spatially Aligned with the cube")
+            img.astype(meta["dtype"]).tofile(sceneFile)
+            meta["labels"].append(label)
+            meta["sources"][label] = stamp
+            # Metadata is only updated once the scene is on disk, so an interrupted build can be re-run
+            sceneFile.flush()
+            writeJson(metaFile, meta)
+
+    return meta
+
+
+# Function to get the [size, modification time] of a scene's file (None if it no longer exists)
+def sceneStamp(label):
+    if not os.path.exists(label):
+        return None
+    stat = os.stat(label)
+    return [stat.st_size, stat.st_mtime]
+
+
+# Function to read the metadata of a temporal cube (see buildCube)
+def readCubeMeta(cubePath):
+    with open(os.path.join(cubePath, "cube.json")) as jsonFile:
+        return json.load(jsonFile)
+
+
+# Function to open a temporal cube as a read-only memory map
+def openCube(cubePath):
+    meta = readCubeMeta(cubePath)
+    cube = np.memmap(os.path.join(cubePath, "scenes.dat"), dtype=meta["dtype"], mode='r',
+                     shape=(len(meta["labels"]), *meta["shape"]))
+    return cube, meta["labels"], tuple(meta["geoTransform"]), meta["projection"]
+
+
+# Function that loads Spatially Aligned data as a memory-mapped (scene, band, height, width) cube for manipulation
+#   Pixels are only read from disk when a block of the cube is accessed
+def loadImages(path, cubePath):
+    buildCube(path, cubePath)
+    return openCube(cubePath)
+
+
+# Histograms are kept as counts of every possible uint16 value for each of the 6 spectral bands -> [band, 65536]
+#   Counts from different blocks/workers/runs are merged by adding them, and can be saved with np.save
+def emptyHistogram(bands=6):
+    return np.zeros((bands, 65536), dtype=np.int64)
+
+
+# Function to add the alpha-valid pixels of a block of scenes to histogram counts
+#   stack: [scene, band, rows, width]
+def updateHistogram(counts, stack):
+    valid = stack[:, 6] > 0
+    for c in range(counts.shape[0]):
+        counts[c] += np.bincount(stack[:, c][valid], minlength=65536)
+    return counts
+
+
+# Function to merge histogram counts (e.g. from different workers, or saved by earlier runs) into a running total
+#   Counts are added to total in place, so no more than one set of counts is held besides it
+def mergeHistograms(total, *counts):
+    for count in counts:
+        total += count
+    return total
+
+
+# Function to compute the histogram counts of one window of the cube (run in worker processes)
+def histogramWindow(cubePath, window):
+    data, _, _ = openWindowSource(cubePath)
+    xOff, yOff, xSize, ySize = window
+    return updateHistogram(emptyHistogram(), np.array(data[:, :, yOff:yOff + ySize, xOff:xOff + xSize]))
+
+
+# Function to compute the histogram counts of the whole cube, window by window in a pool of worker processes
+#   Does not need matplotlib
+def histogramData(cubePath, windowSize=256, workers=None):
+    data, _, _ = openWindowSource(cubePath)
+    _, _, height, width = data.shape
+    windows = makeWindows(width, height, windowSize)
+    # Each window's counts are added to the total as soon as they arrive, so only a few are ever held at once
+    counts = emptyHistogram()
+    if workers == 1:
+        for window in windows:
+            mergeHistograms(counts, histogramWindow(cubePath, window))
+        return counts
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        for future in concurrent.futures.as_completed([executor.submit(histogramWindow, cubePath, window)
+                                                       for window in windows]):
+            mergeHistograms(counts, future.result())
+    return counts
+
+
+# Function to plot histograms from histogram counts
+#   Binned over the range of observed values exactly as plt.hist(values, bins=10000) would have
+def plotHistogram(counts):
+    import matplotlib.pyplot as plt
     bandNames = ["Red", "Green", "Blue", "NIR", "SWIR1", "SWIR2"]
     bandColors = ["red", "green", "blue", "magenta", "aqua", "darkviolet"]
     fig, axs = plt.subplots(2, 3)
     axs = axs.ravel()
-    for c in range(bands):
-        values = []
-        for image in data:
-            for j in range(height):
-                for k in range(width):
-                    if image[6, j, k] > 0:
-                        values.append(image[c, j, k])
-        axs[c].hist(x=values, bins=10000, color=bandColors[c])
+    for c in range(counts.shape[0]):
+        observed = np.flatnonzero(counts[c])
+        values = np.arange(observed[0], observed[-1] + 1) if observed.size else np.arange(1)
+        axs[c].hist(x=values, bins=10000, weights=counts[c, values], color=bandColors[c])
         axs[c].set_title(bandNames[c] + " Band")
         axs[c].set_xlabel("Intensity")
         axs[c].set_ylabel("Count")
     plt.show()
 
 
+# Function to plot histograms of data over time
+#   histogramFile -> also save the histogram counts (.npy) for reuse without rescanning the cube
+def createHistogram(cubePath, histogramFile=None):
+    print("Creating Histograms...")
+    counts = histogramData(cubePath)
+    if histogramFile is not None:
+        np.save(histogramFile, counts)
+    plotHistogram(counts)
+    return counts
+
+
+# Spectral indices and ratios as band math over [red, green, blue, nir, swir1, swir2, alpha] (see bandMath)
+spectralIndices = {
+    "NDVI": "(n - r) / (n + r)",
+    "NDSI": "(g - s1) / (g + s1)",
+    "brightness": ".2126 * r + .7152 * g + .0722 * b",
+    # Blue/SWIR ratios of the cloud mask
+    "ratio1": "(b - s1) / (b + s1)",
+    "ratio2": "(b - s2) / (b + s2)",
+}
+
+
+# Function to compile a set of spectral indices into one band math program (once per process)
+@functools.lru_cache(maxsize=None)
+def indexProgram(names):
+    return bandMath.compileIndices({name: spectralIndices[name] for name in names}, bandMath.sentinelBands)
+
+
+# Function to compute several spectral indices in one pass over a block of the temporal stack -> name -> values
+#   stack: [scene, band, rows, width]
+def blockIndices(stack, names):
+    return bandMath.evaluateIndexDict(indexProgram(tuple(names)), stack, axis=1)
+
+
 # Function to create simple cloud mask
-#   Similar scheme to alpha band
-#   0 -> Cloud Pixel
-#   65535 -> Valid Pixel
-#  [red, green, blue, nir, swir1, swir2, alpha, cloud mask]
-def createCloudMask(data):
+#   Stored separately from the images as a boolean array (one byte per pixel instead of a widened int64 image)
+#   True -> Cloud Pixel
+#   False -> Cloudless/Invalid Pixel
+#  images: [red, green, blue, nir, swir1, swir2, alpha]
+#  clouds: [scene, height, width]
+#   NDSI is always evaluated exactly here (never taken from the rounded planes of the spectral index layer), so the
+#   thresholds give the same mask with or without an index layer
+def createCloudMask(data, blockRows=256, clouds=None):
     print("Adding Cloud Mask...")
-    output = []
-    for image in data:
-        bands, height, width = image.shape
-        # By default, set all pixels to cloudless
-        newImage = np.full((bands + 1, height, width), 65535)
-        newImage[:bands, :, :] = image
-        for j in range(height):
-            for k in range(width):
-                # Only check for clouds within alpha-valid pixels (necessary for calculating cloudiest image)
-                if newImage[6, j, k] > 0:
-                    NDSI = (newImage[1, j, k] - newImage[4, j, k]) / (newImage[1, j, k] + newImage[4, j, k])
-                    ratio1 = (newImage[2, j, k] - newImage[4, j, k]) / (newImage[2, j, k] + newImage[4, j, k])
-                    ratio2 = (newImage[2, j, k] - newImage[5, j, k]) / (newImage[2, j, k] + newImage[5, j, k])
-                    # Check thresholds
-                    if -.13 <= ratio1 and -.13 <= ratio2 and NDSI <= .4:
-                        newImage[7, j, k] = 0
-        output.append(newImage)
-    return output
-
-
-# Function that uses standard NDVI to determine greenest scene (does not include alpha/cloud masked pixels)
-# NDVI = (NIR - Red) / (NIR + Red)
-def findGreenest(data, labels):
-    print("Finding Greenest Scene...")
+    return maskClouds(data, blockRows, clouds)
+
+
+# Function that computes the cloud mask of createCloudMask without printing progress (for callers that mask scenes
+# one at a time and report progress themselves)
+def maskClouds(data, blockRows=256, clouds=None):
     _, height, width = data[0].shape
-    NDVI = []
+    if clouds is None:
+        clouds = np.zeros((len(data), height, width), dtype=bool)
+
+    # NDSI and the ratios are evaluated in one pass per block, into buffers that are reused for every block of every
+    # image (zero sums give NaN/inf ratios, which fail the thresholds the same way the per-pixel version did)
+    program = indexProgram(("ratio1", "ratio2", "NDSI"))
+    ratios = np.empty((3, blockRows, width))
+    test = np.empty((blockRows, width), dtype=bool)
+
+    for i, image in enumerate(data):
+        for start in range(0, height, blockRows):
+            stop = min(start + blockRows, height)
+            rows = stop - start
+            ratio1, ratio2, NDSI = bandMath.evaluateIndices(program, image[:, start:stop, :], out=ratios[:, :rows])
+
+            # Only check for clouds within alpha-valid pixels (necessary for calculating cloudiest image)
+            cloud = clouds[i, start:stop, :]
+            np.greater(image[6, start:stop, :], 0, out=cloud)
+            # Check thresholds
+            np.logical_and(cloud, np.greater_equal(ratio1, -.13, out=test[:rows]), out=cloud)
+            np.logical_and(cloud, np.greater_equal(ratio2, -.13, out=test[:rows]), out=cloud)
+            np.logical_and(cloud, np.less_equal(NDSI, .4, out=test[:rows]), out=cloud)
+    return clouds
+
+
+# Function to load the cloud mask stored alongside a cube as a memory map (clouds.dat)
+#   Masks are only computed for scenes added to the cube since the last run
+#   clouds.json records how many scenes have a finished mask, and is only updated once a scene's mask is on disk, so an
+#   interrupted run picks up where it stopped
+def loadCloudMask(cubePath, data):
+    scenes, _, height, width = data.shape
+    maskFile = os.path.join(cubePath, "clouds.dat")
+    progressFile = os.path.join(cubePath, "clouds.json")
+    done = 0
+    if os.path.exists(progressFile):
+        with open(progressFile) as jsonFile:
+            done = json.load(jsonFile)["scenes"]
+    if done < scenes:
+        print("Adding Cloud Mask...")
+        with open(maskFile, 'ab') as file:
+            file.truncate(scenes * height * width)
+        clouds = np.memmap(maskFile, dtype=bool, mode='r+', shape=(scenes, height, width))
+        for i in range(done, scenes):
+            maskClouds(data[i:i + 1], clouds=clouds[i:i + 1])
+            clouds.flush()
+            writeJson(progressFile, {"scenes": i + 1})
+    return openCloudMask(cubePath, data.shape)
 
-    for image in data:
-        # Create a mask that invalidates cloudy/zero-alpha pixels
-        fullMask = np.logical_and((image[6, :, :] > 0), (image[7, :, :] > 0))
-        NDVIraster = np.zeros((height, width))
-        for j in range(height):
-            for k in range(width):
-                if fullMask[j, k]:
-                    NDVIraster[j, k] = (image[3, j, k] - image[0, j, k]) / (image[3, j, k] + image[0, j, k])
-        NDVIavg = np.sum(NDVIraster) / np.count_nonzero(fullMask == True)
 
-        NDVI.append(NDVIavg)
+# Function to open the cloud mask stored alongside a cube as a read-only memory map
+def openCloudMask(cubePath, shape):
+    scenes, _, height, width = shape
+    return np.memmap(os.path.join(cubePath, "clouds.dat"), dtype=bool, mode='r', shape=(scenes, height, width))
 
-    print(F"Greenest Scene: {labels[np.argmax(NDVI)]}")
-    print(F"     Average NDVI: {max(NDVI)}")
+
+# Superlatives reported from the scene rankings as (superlative, metric, description)
+#   Greenest: standard NDVI, averaged over valid, non-cloud pixels
+#   Snowiest: standard NDSI, averaged over valid, non-cloud pixels
+#   Cloudiest: "NDCI" = Number of pixels with clouds / Number of valid pixels
+#   Brightest: "NDBI" (Relative Luminance), averaged over valid, non-cloud pixels
+#   Source for calculation: https://stackoverflow.com/questions/596216/formula-to-determine-brightness-of-rgb-color
+superlatives = [
+    ("Greenest", "NDVI", "Average NDVI"),
+    ("Snowiest", "NDSI", "Average NDSI"),
+    ("Cloudiest", "clouds", "Ratio of Cloud Masked Pixels"),
+    ("Brightest", "brightness", "Average Relative Luminance"),
+]
+
+# Bands each metric reads from the cube besides alpha (the cloud mask is stored separately)
+#  [red, green, blue, nir, swir1, swir2, alpha]
+metricBands = {
+    "NDVI": (0, 3),
+    "NDSI": (1, 4),
+    "clouds": (),
+    "brightness": (0, 1, 2),
+}
+
+
+# Function to create an empty block cache, holding at most maxBytes of (scene, band, row block) planes
+#   Blocks are keyed by the build id of the cube they were read from (see buildCube), so blocks of a cube that has since
+#   been rebuilt are never returned
+def emptyBlockCache(maxBytes=256 * 2 ** 20):
+    return {"blocks": collections.OrderedDict(), "bytes": 0, "maxBytes": maxBytes, "build": None, "modified": None}
+
+
+# Function to get the build id of the cube a memory map was opened from (None for arrays that are not a cube)
+#   cube.json is only re-read when it has been modified since the last call
+def blockCacheBuild(cache, data):
+    if getattr(data, "filename", None) is None:
+        return None
+    metaFile = os.path.join(os.path.dirname(data.filename), "cube.json")
+    modified = os.path.getmtime(metaFile)
+    if cache["modified"] != modified:
+        cache["build"] = readCubeMeta(os.path.dirname(data.filename))["build"]
+        cache["modified"] = modified
+    return cache["build"]
+
+
+# Function that reads only the given bands of a row block of scenes from the cube -> [scene, band, rows, width]
+#   Bands that are not requested are left as zeros and never read from disk, so band positions stay the same
+#   With a cache, planes are read from disk once and the least recently used ones are evicted over its budget
+def readBands(data, scenes, bands, start, stop, cache=None):
+    stack = np.zeros((len(scenes), data.shape[1], stop - start, data.shape[3]), dtype=data.dtype)
+    build = None if cache is None else blockCacheBuild(cache, data)
+    for i, scene in enumerate(scenes):
+        for band in bands:
+            if cache is None:
+                stack[i, band] = data[scene, band, start:stop, :]
+                continue
+            key = (build, scene, band, start, stop)
+            blocks = cache["blocks"]
+            if key in blocks:
+                blocks.move_to_end(key)
+            else:
+                blocks[key] = np.array(data[scene, band, start:stop, :])
+                cache["bytes"] += blocks[key].nbytes
+                while cache["bytes"] > cache["maxBytes"] and len(blocks) > 1:
+                    cache["bytes"] -= blocks.popitem(last=False)[1].nbytes
+            stack[i, band] = blocks[key]
+    return stack
+
+
+# Function that adds the statistics of a block of scenes to running per-scene totals
+#   stack: [scene, band, rows, width]
+#   cloud: [scene, rows, width]
+#   indices: optional spectral indices of the block (see blockIndex)
+#   Only the metrics that have totals are computed
+def accumulateStatistics(totals, stack, cloud, indices=None):
+    # Create a mask that invalidates cloudy/zero-alpha pixels
+    valid = np.logical_and(stack[:, 6] > 0, np.logical_not(cloud))
+    indices = {} if indices is None else indices
+    # All the metrics' indices are evaluated in one pass over the block
+    missing = [metric for metric in ("NDVI", "NDSI", "brightness") if metric in totals and metric not in indices]
+    if missing and "source" not in indices:
+        indices.update(blockIndices(stack, missing))
+    for metric in ("NDVI", "NDSI", "brightness"):
+        if metric not in totals:
+            continue
+        values = blockIndex(indices, metric, stack)
+        # Summed in float64 whatever the precision of the indices
+        totals[metric] += np.sum(values, axis=(1, 2), where=valid, dtype=np.float64)
+        totals[metric + "^2"] += np.sum(np.square(values, dtype=np.float64), axis=(1, 2), where=valid)
+    totals["valid"] += np.count_nonzero(valid, axis=(1, 2))
+    totals["clouds"] += np.count_nonzero(cloud, axis=(1, 2))
+    totals["alpha"] += np.count_nonzero(stack[:, 6] == 65535, axis=(1, 2))
+
+
+# Function that creates empty per-scene statistic totals for the given metrics
+def emptyStatistics(scenes, metrics=tuple(metricBands)):
+    keys = ["valid", "clouds", "alpha"]
+    for metric in ("NDVI", "NDSI", "brightness"):
+        if metric in metrics:
+            keys += [metric, metric + "^2"]
+    return {key: np.zeros(scenes) for key in keys}
+
+
+# Function that turns per-scene statistic totals into per-scene metrics
+#   NDVI/NDSI/brightness: mean over valid, non-cloud pixels
+#   clouds: cloud masked pixels / valid pixels
+#   Also returns the standard error of each metric, treating the pixels as independent samples
+def finishStatistics(totals):
+    values = {}
+    errors = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for metric in ("NDVI", "NDSI", "brightness"):
+            if metric not in totals:
+                continue
+            values[metric] = totals[metric] / totals["valid"]
+            variance = np.maximum(totals[metric + "^2"] / totals["valid"] - np.square(values[metric]), 0)
+            errors[metric] = np.sqrt(variance / totals["valid"])
+        values["clouds"] = totals["clouds"] / totals["alpha"]
+        errors["clouds"] = np.sqrt(values["clouds"] * (1 - values["clouds"]) / totals["alpha"])
+    return values, errors
+
+
+# Function to sort scenes from highest to lowest value of a metric
+#   Stable sort keeps the first scene on ties (as np.argmax did)
+def rankOrder(value):
+    return np.argsort(-value, kind='stable')
+
+
+# Function to split scene indices into groups of at most size scenes
+def sceneGroups(scenes, size):
+    return [list(range(start, min(start + size, scenes))) for start in range(0, scenes, size)]
+
+
+# Approximate bytes held per scene and pixel of a block while its statistics are accumulated (the 7-band uint16
+# stack, float64 indices and their scratch buffers)
+statisticsPixelBytes = 64
+
+
+# Function that computes the statistics of every scene in one pass over the cube, and ranks the scenes by each of them
+#   scenes: optional list of scene indices to restrict the pass to
+#   metrics: optional subset of the metrics, only the bands they need are read (see metricBands)
+#   cache: optional block cache (see emptyBlockCache) shared between calls
+#   indexCache: optional spectral index layer (see emptyIndexCache), then only alpha is read from the cube
+#   maxBytes: memory budget of a row block, scenes are ranked in groups small enough for a block to fit in it
+#   Returns metric -> [(label, value), ...] sorted from highest to lowest
+def rankScenes(data, clouds, labels, blockRows=64, scenes=None, metrics=tuple(metricBands), cache=None,
+               indexCache=None, maxBytes=256 * 2 ** 20):
+    print("Ranking Scenes...")
+    scenes = list(range(len(labels))) if scenes is None else list(scenes)
+    # Without room for all the planes a scene needs, they would be evicted and recomputed for every row block, so the
+    # indices are evaluated block by block instead
+    if indexCache is not None and not indexLayerFits(indexCache, data.shape, metrics):
+        indexCache = None
+    bands = [6] if indexCache is not None else sorted({6}.union(*(metricBands[metric] for metric in metrics)))
+    height, width = data.shape[2:]
+    totals = emptyStatistics(len(scenes), metrics)
+    # The index layer caches whole-scene planes, so its scenes are ranked one at a time (all of a scene's row blocks
+    # hit the same planes) instead of cycling through every scene's planes for each row block
+    groupSize = 1 if indexCache is not None else max(maxBytes // (blockRows * width * statisticsPixelBytes), 1)
+    for group in sceneGroups(len(scenes), groupSize):
+        groupScenes = [scenes[i] for i in group]
+        groupTotals = emptyStatistics(len(group), metrics)
+        for start in range(0, height, blockRows):
+            stop = min(start + blockRows, height)
+            indices = None
+            if indexCache is not None:
+                window = (0, start, width, stop - start)
+                indices = {"source": indexSource(indexCache, data, labels, groupScenes, window, exact=True)}
+            accumulateStatistics(groupTotals, readBands(data, groupScenes, bands, start, stop, cache),
+                                 np.array(clouds[groupScenes, start:stop, :]), indices)
+        for key, value in groupTotals.items():
+            totals[key][group] = value
+
+    values, _ = finishStatistics(totals)
+    return {metric: [(labels[scenes[i]], value[i]) for i in rankOrder(value)] for metric, value in values.items()}
+
+
+# Function to read a reduced-resolution (1 / factor) version of a scene
+#   GDAL serves the read from a matching overview if there is one, or otherwise from a strided pixel sample
+#   overviewPath -> nearest-neighbour overviews (so the values are real observations) are built for a VRT copy of the
+#   scene in that directory, never next to the scene itself (where they would be listed as scenes)
+#   The VRT copy is keyed by a hash of the scene (see sceneHash), so a rewritten scene gets a new copy and overviews,
+#   and the copies of its earlier versions are removed
+def readReduced(label, factor, overviewPath=None):
+    dataset = gdal.Open(label)
+    if overviewPath is not None and dataset.GetRasterBand(1).GetOverviewCount() == 0:
+        stem = os.path.splitext(os.path.basename(label))[0]
+        vrtFile = os.path.join(overviewPath, stem + "_" + sceneHash(label) + ".vrt")
+        if not os.path.exists(vrtFile):
+            for name in os.listdir(overviewPath):
+                if re.fullmatch(re.escape(stem) + r"(_[0-9a-f]{40})?\.vrt(\.ovr)?", name):
+                    os.remove(os.path.join(overviewPath, name))
+            gdal.Translate(vrtFile, dataset, format='VRT')
+        dataset = gdal.Open(vrtFile)
+        if dataset.GetRasterBand(1).GetOverviewCount() == 0:
+            dataset.BuildOverviews('NEAREST', [factor])
+    return dataset.ReadAsArray(buf_xsize=max(dataset.RasterXSize // factor, 1),
+                               buf_ysize=max(dataset.RasterYSize // factor, 1))
+
+
+# Function that ranks scenes approximately from reduced-resolution reads, cutting I/O by ~factor^2
+#   Each estimate comes with an error bound (z standard errors, ~95% for z=1.96)
+#   If the full-resolution cube is given, every scene that could be in the topK of a metric is refined to its exact
+#   value (with an error bound of 0) and re-ranked
+#   Returns metric -> [(label, value, error bound), ...] sorted from highest to lowest
+def rankScenesApprox(labels, factor=16, overviewPath=None, z=1.96, data=None, clouds=None, topK=3,
+                     metrics=tuple(metricBands), cache=None, indexCache=None):
+    print("Ranking Scenes (approximate)...")
+    if overviewPath is not None:
+        os.makedirs(overviewPath, exist_ok=True)
+    # Scenes are sampled and accumulated one at a time, so only one reduced scene is held at once
+    totals = emptyStatistics(len(labels), metrics)
+    for i, label in enumerate(labels):
+        sample = readReduced(label, factor, overviewPath)[np.newaxis]
+        sceneTotals = emptyStatistics(1, metrics)
+        accumulateStatistics(sceneTotals, sample, maskClouds(sample))
+        for key, value in sceneTotals.items():
+            totals[key][i] = value[0]
+    values, errors = finishStatistics(totals)
+    bounds = {metric: z * error for metric, error in errors.items()}
+
+    if data is not None and topK > 0:
+        # Candidates are the scenes whose upper bound reaches the topK-th highest lower bound, and the scenes without
+        # an estimate (no valid sampled pixels), which never set the threshold
+        candidates = set()
+        for metric, value in values.items():
+            lower = value - bounds[metric]
+            lower = np.where(np.isfinite(lower), lower, -np.inf)
+            k = min(topK, len(value))
+            threshold = np.partition(lower, len(value) - k)[len(value) - k]
+            candidates.update(int(i) for i in np.flatnonzero(value + bounds[metric] >= threshold))
+            candidates.update(int(i) for i in np.flatnonzero(np.isnan(value)))
+        candidates = sorted(candidates)
+        exact = rankScenes(data, clouds, labels, scenes=candidates, metrics=metrics, cache=cache,
+                           indexCache=indexCache)
+        for metric, ranking in exact.items():
+            for label, value in ranking:
+                values[metric][labels.index(label)] = value
+                bounds[metric][labels.index(label)] = 0
+
+    return {metric: [(labels[i], value[i], bounds[metric][i]) for i in rankOrder(value)]
+            for metric, value in values.items()}
+
+
+# Function that prints the greenest, snowiest, cloudiest and brightest scenes from the scene rankings
+#   factor -> rank approximately from reduced-resolution reads, refining the top candidates at full resolution
+#     The reads come from overviews built once in overviewPath (None -> strided reads of the full-resolution scenes,
+#     which do not cut I/O)
+#   names -> only find some of the superlatives (e.g. ["Cloudiest"] only reads alpha and the cloud mask)
+def findSuperlatives(data, clouds, labels, factor=None, names=None, cache=None, indexCache=None,
+                     overviewPath=overview_dir):
+    found = [entry for entry in superlatives if names is None or entry[0] in names]
+    metrics = [metric for _, metric, _ in found]
+    if factor is None:
+        rankings = rankScenes(data, clouds, labels, metrics=metrics, cache=cache, indexCache=indexCache)
+    else:
+        rankings = rankScenesApprox(labels, factor, overviewPath, data=data, clouds=clouds, metrics=metrics,
+                                    cache=cache, indexCache=indexCache)
+    for superlative, metric, description in found:
+        label, value = rankings[metric][0][:2]
+        print(F"{superlative} Scene: {label}")
+        if factor is None:
+            print(F"     {description}: {value}")
+        else:
+            print(F"     {description}: {value} +/- {rankings[metric][0][2]}")
+    return rankings
+
+
+# Spectral indices used to rank observations, each computed over a block of the temporal stack -> [scene, rows, width]
+# NDVI = (NIR - Red) / (NIR + Red)
+def indexNDVI(stack):
+    return blockIndices(stack, ("NDVI",))["NDVI"]
 
 
-# Function that uses standard NDSI to determine snowiest scene (does not include alpha/cloud masked pixels)
 # NDSI = (Green - SWIR1) / (Green + SWIR1)
-def findSnowiest(data, labels):
-    print("Finding Snowiest Scene...")
-    _, height, width = data[0].shape
-    NDSI = []
+def indexNDSI(stack):
+    return blockIndices(stack, ("NDSI",))["NDSI"]
 
-    for image in data:
-        # Create a mask that invalidates cloudy/zero-alpha pixels
-        fullMask = np.logical_and((image[6, :, :] > 0), (image[7, :, :] > 0))
-        NDSIraster = np.zeros((height, width))
-        for j in range(height):
-            for k in range(width):
-                if fullMask[j, k]:
-                    NDSIraster[j, k] = (image[1, j, k] - image[4, j, k]) / (image[1, j, k] + image[4, j, k])
-        NDSIavg = np.sum(NDSIraster) / np.count_nonzero(fullMask == True)
 
-        NDSI.append(NDSIavg)
+# Relative Luminance = .2126 * Red + .7152 * Green + .0722 * Blue
+def indexBrightness(stack):
+    return blockIndices(stack, ("brightness",))["brightness"]
 
-    print(F"Snowiest Scene: {labels[np.argmax(NDSI)]}")
-    print(F"     Average NDSI: {max(NDSI)}")
 
+qualityIndices = {
+    "NDVI": indexNDVI,
+    "NDSI": indexNDSI,
+    "brightness": indexBrightness,
+}
 
-# Function that counts cloud masked pixels to determine cloudiest scene
-# "NDCI" = Number of pixels with clouds / Number of valid pixels
-def findCloudiest(data, labels):
-    print("Finding Cloudiest Scene...")
-    NDCI = []
 
-    for image in data:
-        NDCI.append(np.count_nonzero(image[7, :, :] == 0) / np.count_nonzero(image[6, :, :] == 65535))
+# Function to get a spectral index for a block, computing it only once per block no matter how many composites use it
+#   If indices has a "source" function (see indexSource), the block is taken from the shared spectral index layer
+def blockIndex(indices, name, stack):
+    if name not in indices:
+        indices[name] = indices["source"](name) if "source" in indices else qualityIndices[name](stack)
+    return indices[name]
 
-    print(F"Cloudiest Scene: {labels[np.argmax(NDCI)]}")
-    print(F"     Ratio of Cloud Masked Pixels: {max(NDCI)}")
 
+# Shared spectral index layer, computing each index of a cube scene once for the rankings and composites
+#   Planes computed in memory are exact (float64), evicting the least recently used ones over maxBytes, and consumers
+#   that only take planes that fit (see indexLayerFits)
+#   With an indexPath, planes are also persisted as float16 .npy files keyed by a hash of the scene, so later runs and
+#   worker processes only read them (float16 rounding can flip values within ~1e-3 of a threshold), consumers that must
+#   match the computation without the layer (rankings, incremental folds) ask for exact planes and never use them
+#   blockCache -> planes are computed from bands read through that block cache (see emptyBlockCache), so bands shared
+#   by several indices (e.g. red by NDVI and brightness) or also read by the rankings are only read from disk once
+def emptyIndexCache(maxBytes=512 * 2 ** 20, indexPath=None, blockCache=None):
+    if indexPath is not None:
+        os.makedirs(indexPath, exist_ok=True)
+    return {"planes": collections.OrderedDict(), "bytes": 0, "maxBytes": maxBytes, "indexPath": indexPath,
+            "blockCache": blockCache}
 
-# Function that uses relative luminance to determine brightest scene (does not include alpha/cloud masked pixels)
-# "NDBI" (Relative Luminance) = .2126 * Red + .7152 * Green + .0722 * Blue
-# Source for calculation: https://stackoverflow.com/questions/596216/formula-to-determine-brightness-of-rgb-color
-def findBrightest(data, labels):
-    print("Finding Brightest Scene...")
-    _, height, width = data[0].shape
-    NDBI = []
 
-    for image in data:
-        # Create a mask that invalidates cloudy/zero-alpha pixels
-        fullMask = np.logical_and((image[6, :, :] > 0), (image[7, :, :] > 0))
-        NDBIraster = np.zeros((height, width))
-        for j in range(height):
-            for k in range(width):
-                if fullMask[j, k]:
-                    NDBIraster[j, k] = .2126 * image[0, j, k] + .7152 * image[1, j, k] + .0722 * image[2, j, k]
-        NDBIavg = np.sum(NDBIraster) / np.count_nonzero(fullMask == True)
+# Data type of the spectral index planes computed in memory (the same as the indices computed block by block)
+planeDtype = np.float64
 
-        NDBI.append(NDBIavg)
 
-    print(F"Brightest Scene: {labels[np.argmax(NDBI)]}")
-    print(F"     Average Relative Luminance: {max(NDBI)}")
+# Function to check whether the planes of some spectral indices of one scene fit in a spectral index layer's budget
+#   Metrics that are not spectral indices (e.g. clouds) need no plane
+def indexLayerFits(cache, shape, names):
+    planes = len([name for name in names if name in qualityIndices])
+    return planes * shape[-2] * shape[-1] * np.dtype(planeDtype).itemsize <= cache["maxBytes"]
 
 
-# Function to create Mean composite
-def makeMean(data, path, geoTransform, projection):
-    print("Creating Mean Composite...")
-    bands, height, width = data[0].shape
-    mean = np.zeros((bands, height, width))
-    tot = np.zeros((bands, height, width))
+# Function to hash a scene by its file's path, size and modification time (changes whenever the scene is rewritten)
+def sceneHash(label):
+    stat = os.stat(label)
+    return hashlib.sha1(json.dumps([label, stat.st_size, stat.st_mtime]).encode()).hexdigest()
 
-    # Simply adds values of valid pixels to a numpy array while keeping track of how many valid values for each pixel
-    for image in data:
-        for j in range(height):
-            for k in range(width):
-                if image[6, j, k] > 0 and image[7, j, k] > 0:
-                    mean[:, j, k] += image[:, j, k]
-                    tot[:, j, k] += 1
 
-    mean = mean / tot
-    createTif(path + '\\' + "mean.tif", mean,
-              width, height, bands, geoTransform, projection)
+# Function to get one spectral index of one scene of the cube -> [height, width]
+#   Computed row block by row block, reading only the bands the index needs
+#   compute=False -> only returns a plane already in memory or on disk (None otherwise)
+#   exact=True -> only returns a plane computed in memory (never a rounded float16 plane of the persisted layer)
+def sceneIndex(cache, data, labels, scene, name, blockRows=256, compute=True, exact=False):
+    key = (labels[scene], name)
+    planes = cache["planes"]
+    if key in planes and (not exact or planes[key].dtype == planeDtype):
+        planes.move_to_end(key)
+        return planes[key]
+    if key in planes:
+        cache["bytes"] -= planes.pop(key).nbytes
 
+    file = None
+    if cache["indexPath"] is not None:
+        file = os.path.join(cache["indexPath"], name + "_" + sceneHash(labels[scene]) + ".npy")
+    if file is not None and os.path.exists(file) and not exact:
+        plane = np.load(file, mmap_mode='r')
+    elif not compute:
+        return None
+    else:
+        height = data.shape[2]
+        plane = np.empty(data.shape[2:], dtype=planeDtype)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for start in range(0, height, blockRows):
+                stop = min(start + blockRows, height)
+                stack = readBands(data, [scene], metricBands[name], start, stop, cache["blockCache"])
+                plane[start:stop] = qualityIndices[name](stack)[0]
+        if file is not None and not os.path.exists(file):
+            # Written under a per-process name first, so concurrent workers never see a partial file
+            tmpFile = file + "." + str(os.getpid()) + ".npy"
+            np.save(tmpFile, plane.astype(np.float16))
+            os.replace(tmpFile, file)
+        if file is not None and not exact:
+            plane = np.load(file, mmap_mode='r')
+
+    planes[key] = plane
+    cache["bytes"] += plane.nbytes
+    while cache["bytes"] > cache["maxBytes"] and len(planes) > 1:
+        cache["bytes"] -= planes.popitem(last=False)[1].nbytes
+    return plane
+
+
+# Function that makes a "source" of the spectral indices of a window of some scenes for blockIndex
+#   window: (xOff, yOff, xSize, ySize)
+#   stack -> the window's stack, which an index is computed from (for the window alone) if any of its scene planes is
+#   not in the layer yet, instead of computing whole scene planes (e.g. in workers, see fillIndexLayer)
+#   exact -> only exact planes are used (see sceneIndex)
+def indexSource(cache, data, labels, scenes, window, stack=None, exact=False):
+    xOff, yOff, xSize, ySize = window
+
+    def source(name):
+        planes = [sceneIndex(cache, data, labels, scene, name, compute=stack is None, exact=exact) for scene in scenes]
+        if any(plane is None for plane in planes):
+            return qualityIndices[name](stack)
+        return np.stack([plane[yOff:yOff + ySize, xOff:xOff + xSize] for plane in planes])
+    return source
 
-# Function to create Min composite
-def makeMin(data, path, geoTransform, projection):
-    print("Creating Min Composite...")
-    bands, height, width = data[0].shape
-    minIm = np.full((bands, height, width), 16384)
 
-    # Iterates through each band of each pixel of each image to find the minimum value for each band in a pixel
-    for image in data:
-        for j in range(height):
-            for k in range(width):
-                if image[6, j, k] > 0 and image[7, j, k] > 0:
-                    for c in range(bands):
-                        minIm[c, j, k] = min(minIm[c, j, k], image[c, j, k])
+# Function to add the planes of some spectral indices of every scene to the persisted spectral index layer, one scene
+# at a time, so worker processes only ever read them
+def fillIndexLayer(indexPath, data, labels, names):
+    cache = emptyIndexCache(0, indexPath)
+    for scene in range(len(labels)):
+        for name in names:
+            sceneIndex(cache, data, labels, scene, name)
 
-    createTif(path + '\\' + "min.tif", minIm,
-              width, height, bands, geoTransform, projection)
+
+# Composite functions, each reducing one block of the temporal stack to a block of the composite
+#   stack: [scene, band, rows, width]
+#   valid: [scene, rows, width] (alpha-valid and cloudless observations)
+#   indices: spectral indices already computed for this block (see blockIndex)
+
+# Function to create Mean composite
+#   Simply adds values of valid pixels while keeping track of how many valid values for each pixel
+def compositeMean(stack, valid, indices):
+    mean = np.zeros(stack.shape[1:])
+    for image, mask in zip(stack, valid):
+        np.add(mean, image, out=mean, where=mask)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return mean / np.count_nonzero(valid, axis=0)
+
+
+# Function to create Min composite
+def compositeMin(stack, valid, indices):
+    minIm = np.full(stack.shape[1:], 16384)
+    for image, mask in zip(stack, valid):
+        np.minimum(minIm, image, out=minIm, where=mask)
+    return minIm
 
 
 # Function to create Max composite
-def makeMax(data, path, geoTransform, projection):
-    print("Creating Max Composite...")
-    bands, height, width = data[0].shape
-    maxIm = np.zeros((bands, height, width))
+def compositeMax(stack, valid, indices):
+    maxIm = np.zeros(stack.shape[1:])
+    for image, mask in zip(stack, valid):
+        np.maximum(maxIm, image, out=maxIm, where=mask)
+    return maxIm
 
-    # Iterates through each band of each pixel of each image to find the maximum value for each band in a pixel
-    for image in data:
-        for j in range(height):
-            for k in range(width):
-                if image[6, j, k] > 0 and image[7, j, k] > 0:
-                    for c in range(bands):
-                        maxIm[c, j, k] = max(maxIm[c, j, k], image[c, j, k])
 
-    createTif(path + '\\' + "max.tif", maxIm,
-              width, height, bands, geoTransform, projection)
+# Function to select the rank-th smallest valid value (0-based) of every pixel in a uint16 time stack
+#   Counting selection over the value's 4-bit digits, most significant first: a histogram of the current digit
+#   (over the valid values that match the digits selected so far) locates the digit holding the rank
+#   Exact for any uint16 value, and only needs 16 counters per pixel regardless of the number of scenes
+#   values: [scene, pixels]
+#   valid: [scene, pixels]
+#   rank: [pixels]
+def selectRank(values, valid, rank, bits=4):
+    pixels = np.arange(rank.size)
+    counts = np.empty((1 << bits, rank.size), dtype=np.int32)
+    digitMask = (1 << bits) - 1
+    remaining = rank.astype(np.int64)
+    selected = np.zeros(rank.size, dtype=np.uint16)
+    for shift in range(16 - bits, -1, -bits):
+        counts[:] = 0
+        for value, ok in zip(values, valid):
+            if shift + bits < 16:
+                ok = ok & ((value >> (shift + bits)) == (selected >> (shift + bits)))
+            counts[(value >> shift) & digitMask, pixels] += ok
+        cumulative = np.cumsum(counts, axis=0)
+        digit = np.argmax(cumulative > remaining, axis=0)
+        remaining -= cumulative[digit, pixels] - counts[digit, pixels]
+        selected |= (digit << shift).astype(np.uint16)
+    return selected
+
+
+# Function to create an arbitrary (linearly interpolated) percentile composite, matching np.percentile exactly
+#   Selects the two order statistics around the percentile's position for each band
+def compositePercentile(stack, valid, indices, q):
+    scenes, bands, rows, width = stack.shape
+    validFlat = valid.reshape(scenes, -1)
+    count = np.count_nonzero(validFlat, axis=0)
+    position = q / 100 * (count - 1)
+    lower = np.floor(position).astype(np.int64)
+    upper = np.ceil(position).astype(np.int64)
+    t = position - lower
+
+    percentile = np.empty((bands, rows * width))
+    for c in range(bands):
+        values = stack[:, c].reshape(scenes, -1)
+        a = selectRank(values, validFlat, lower).astype(np.float64)
+        b = selectRank(values, validFlat, upper).astype(np.float64) if np.any(upper != lower) else a
+        # Same interpolation formula as np.percentile
+        percentile[c] = np.where(t >= .5, b - (b - a) * (1 - t), a + (b - a) * t)
+    # No valid values -> NaN (as with np.median of an empty list)
+    percentile[:, count == 0] = np.nan
+    return percentile.reshape(bands, rows, width)
 
 
 # Function to create Median composite
-def makeMedian(data, path, geoTransform, projection):
-    print("Creating Median Composite...")
-    bands, height, width = data[0].shape
-    median = np.zeros((bands, height, width))
-
-    # Appends valid values of each band of each pixel to a list of lists, and sets the result equal to the median
-    for j in range(height):
-        for k in range(width):
-            LoL = [[] for c in range(bands)]
-            for image in data:
-                if image[6, j, k] > 0 and image[7, j, k] > 0:
-                    for c in range(bands):
-                        LoL[c].append(image[c, j, k])
-            for c in range(bands):
-                median[c, j, k] = np.median(LoL[c])
-
-    createTif(path + '\\' + "median.tif", median,
-              width, height, bands, geoTransform, projection)
-
-
-# Function to create Greenest composite
-def makeGreenest(data, path, geoTransform, projection):
-    print("Creating Greenest Composite...")
-    bands, height, width = data[0].shape
-    greenest = np.zeros((bands, height, width))
-
-    # Appends NDVI values of each pixel to an array, finds the index of the max, and sets result equal to that image's
-    # pixel value "packet" (package of 7 bands)
-    for j in range(height):
-        for k in range(width):
-            NDVI = np.zeros((len(data),))
-            i = 0
-            for image in data:
-                if image[6, j, k] > 0 and image[7, j, k] > 0:
-                    NDVI[i] = (image[3, j, k] - image[0, j, k]) / (image[3, j, k] + image[0, j, k])
-                # If pixel is invalid/cloudy, set NDVI below minimum value
-                else:
-                    NDVI[i] = -2
-                i += 1
-            greenest[:, j, k] = data[np.argmax(NDVI)][:, j, k]
-
-    bands, height, width = greenest.shape
-    createTif(path + '\\' + "greenest.tif", greenest,
-              width, height, bands, geoTransform, projection)
-
-
-# Function to create 85% Greenest composite
-def make85Greenest(data, path, geoTransform, projection):
-    print("Creating 85% Greenest Composite...")
-    bands, height, width = data[0].shape
-    greenest85 = np.zeros((bands, height, width))
-
-    # Appends NDVI values of each pixel to an array, removes invalid values in the array, sorts the array, gets the
-    # index of the 85th percentile, and sets result equal to that image's pixel value "packet" (package of 7 bands)
-    for j in range(height):
-        for k in range(width):
-            NDVI = np.zeros((len(data),))
-            i = 0
-            for image in data:
-                if image[6, j, k] > 0 and image[7, j, k] > 0:
-                    NDVI[i] = (image[3, j, k] - image[0, j, k]) / (image[3, j, k] + image[0, j, k])
-                # If pixel is invalid/cloudy, set NDVI below minimum value
-                else:
-                    NDVI[i] = -2
-                i += 1
-            sortedNDVI = np.sort(np.delete(NDVI, np.where(NDVI == -2)))
-
-            greenest85[:, j, k] = data[np.where(NDVI == sortedNDVI[round(.85 * len(sortedNDVI)) - 1])[0][0]][:, j, k]
-
-    bands, height, width = greenest85.shape
-    createTif(path + '\\' + "greenest85.tif", greenest85,
-              width, height, bands, geoTransform, projection)
-
-
-# Abstract function to create a GeoTIFF composite from numpy array
-def createTif(name, data, width, height, bands, geoTransform, projection):
-    bands -= 1  # Exclude cloud mask
+#   Kept with the block's indices, so the Medoid composite reuses it
+def compositeMedian(stack, valid, indices):
+    if "median" not in indices:
+        indices["median"] = compositePercentile(stack, valid, indices, 50)
+    return indices["median"]
+
+
+# Function to create Medoid composite, where each pixel is the value "packet" of the observation closest (squared
+# Euclidean distance over the 6 spectral bands) to the per-pixel multi-band median
+#   Distances are accumulated one band at a time, so memory stays at one float per observation
+#   Ties go to the first scene, pixels without valid observations are left empty
+def compositeMedoid(stack, valid, indices):
+    median = compositeMedian(stack, valid, indices)
+    distance = np.zeros(valid.shape)
+    tmp = np.empty(valid.shape)
+    for c in range(6):
+        np.subtract(stack[:, c], median[c], out=tmp, dtype=np.float64)
+        distance += np.square(tmp, out=tmp)
+    distance[~valid] = np.inf
+    winner = np.argmin(distance, axis=0)
+    medoid = np.take_along_axis(stack, winner[np.newaxis, np.newaxis], axis=0)[0]
+    medoid[:, np.count_nonzero(valid, axis=0) == 0] = 0
+    return medoid
+
+
+# Function to grow a [scene, rows, width] mask by one pixel in every direction (3x3 dilation)
+def dilate(mask):
+    grown = mask.copy()
+    grown[:, 1:] |= mask[:, :-1]
+    grown[:, :-1] |= mask[:, 1:]
+    rows = grown.copy()
+    grown[:, :, 1:] |= rows[:, :, :-1]
+    grown[:, :, :-1] |= rows[:, :, 1:]
+    return grown
+
+
+# Function to compute the (chessboard) distance of every pixel to the closest cloud in its scene, capped at maxDistance
+#   cloud: [scene, rows, width]
+def cloudDistance(cloud, maxDistance):
+    distance = np.full(cloud.shape, maxDistance, dtype=np.int16)
+    reached = cloud
+    distance[reached] = 0
+    for d in range(1, maxDistance):
+        grown = dilate(reached)
+        distance[grown & ~reached] = d
+        reached = grown
+    return distance
+
+
+# Function to compute the distance to clouds of one window of the cube (see cloudDistance)
+#   Clouds are read with a margin of maxDistance pixels around the window, so distances are the same as over the
+#   whole scene no matter how the cube is split into windows
+def cloudDistanceWindow(clouds, window, maxDistance):
+    xOff, yOff, xSize, ySize = window
+    _, height, width = clouds.shape
+    top, bottom = max(yOff - maxDistance, 0), min(yOff + ySize + maxDistance, height)
+    left, right = max(xOff - maxDistance, 0), min(xOff + xSize + maxDistance, width)
+    cloud = np.array(clouds[:, top:bottom, left:right])
+    return cloudDistance(cloud, maxDistance)[:, yOff - top:yOff - top + ySize, xOff - left:xOff - left + xSize]
+
+
+# Function to create a quality-weighted Mean composite
+#   Each valid observation is weighted by its NDVI, rescaled to [0, 1], and by its distance to the closest cloud
+#   (relative to maxDistance pixels), so observations next to clouds (haze, shadows) and without vegetation count less
+#   Uses the window's cloud mask if the block comes with one (see compositeWindow), otherwise every invalid pixel of
+#   the block counts as a cloud
+#   Pixels without valid observations (or only zero weights) are left empty
+def compositeWeightedMean(stack, valid, indices, maxDistance=10):
+    if "cloudSource" in indices:
+        distance = indices["cloudSource"](maxDistance)
+    else:
+        distance = cloudDistance(~valid, maxDistance)
+    weight = np.clip((blockIndex(indices, "NDVI", stack) + 1) / 2, 0, 1)
+    weight *= distance / maxDistance
+    weight[~valid | np.isnan(weight)] = 0
+    total = np.sum(weight, axis=0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.stack([np.einsum('srw,srw->rw', weight, stack[:, c]) for c in range(stack.shape[1])]) / total
+
+
+# Function to create a quality mosaic, where each pixel is the value "packet" (package of 7 bands) of the observation
+# ranked by a spectral index
+#   q=None -> observation with the max index (first one on ties), pixels without valid observations take the first scene
+#   q -> observation at the q-th percentile of the valid index values (first one with that value), found with
+#        argpartition instead of a full sort, pixels without valid observations are left empty
+def compositeQualityMosaic(stack, valid, indices, index="NDVI", q=None):
+    quality = blockIndex(indices, index, stack)
+    if q is None:
+        winner = np.argmax(np.where(valid, quality, -np.inf), axis=0)
+        return np.take_along_axis(stack, winner[np.newaxis, np.newaxis], axis=0)[0]
+
+    count = np.count_nonzero(valid, axis=0)
+    rank = np.maximum(np.rint(q / 100 * count).astype(np.int64) - 1, 0)
+    ranked = np.where(valid, quality, np.inf)
+    order = np.argpartition(ranked, np.unique(rank), axis=0)
+    value = np.take_along_axis(ranked, np.take_along_axis(order, rank[np.newaxis], axis=0), axis=0)
+    winner = np.argmax(valid & (quality == value), axis=0)
+    mosaic = np.take_along_axis(stack, winner[np.newaxis, np.newaxis], axis=0)[0]
+    mosaic[:, count == 0] = 0
+    return mosaic
+
+
+# Available composites as name -> (function, output file)
+compositeFunctions = {
+    "mean": (compositeMean, "mean.tif"),
+    "min": (compositeMin, "min.tif"),
+    "max": (compositeMax, "max.tif"),
+    "median": (compositeMedian, "median.tif"),
+    "greenest": (functools.partial(compositeQualityMosaic, index="NDVI"), "greenest.tif"),
+    "greenest85": (functools.partial(compositeQualityMosaic, index="NDVI", q=85), "greenest85.tif"),
+    "medoid": (compositeMedoid, "medoid.tif"),
+    "weighted": (compositeWeightedMean, "weighted.tif"),
+}
+
+# Spectral indices the composites rank or weight observations by (added to the index layer before makeComposites
+# dispatches any window)
+compositeIndices = {
+    "greenest": ("NDVI",),
+    "greenest85": ("NDVI",),
+    "weighted": ("NDVI",),
+}
+
+
+# Function to add an arbitrary percentile composite to the available composites (e.g. 90 -> "p90", "p90.tif")
+def addPercentileComposite(q):
+    name = "p" + str(q)
+    compositeFunctions[name] = (functools.partial(compositePercentile, q=q), name + ".tif")
+    return name
+
+
+# Function to add a quality mosaic composite ranked by any of the quality indices (e.g. "snowiest", "NDSI")
+def addQualityComposite(name, index, q=None):
+    compositeFunctions[name] = (functools.partial(compositeQualityMosaic, index=index, q=q), name + ".tif")
+    return name
+
+
+# Function to open a cube and its cloud mask (once computed) only once per (worker) process
+#   Cached on the files' modification times, so a cube that has been added to is reopened
+def openWindowSource(cubePath):
+    files = [os.path.join(cubePath, name) for name in ("cube.json", "clouds.dat")]
+    return openWindowFiles(cubePath, tuple(os.path.getmtime(file) if os.path.exists(file) else None for file in files))
+
+
+@functools.lru_cache(maxsize=None)
+def openWindowFiles(cubePath, modified):
+    cube, labels, _, _ = openCube(cubePath)
+    clouds = openCloudMask(cubePath, cube.shape) if modified[1] is not None else None
+    return cube, clouds, labels
+
+
+# Function to open the persisted spectral index layer only once per (worker) process
+@functools.lru_cache(maxsize=None)
+def openIndexCache(indexPath):
+    return emptyIndexCache(indexPath=indexPath)
+
+
+# Function to compute the requested composites for one window of the cube
+#   Runs in worker processes, which open the memory-mapped cube themselves so no arrays are pickled
+#   window: (xOff, yOff, xSize, ySize)
+#   indexPath -> spectral indices are shared through the persisted spectral index layer (see emptyIndexCache)
+def compositeWindow(cubePath, functions, window, indexPath=None):
+    data, clouds, labels = openWindowSource(cubePath)
+    xOff, yOff, xSize, ySize = window
+    stack = np.array(data[:, :, yOff:yOff + ySize, xOff:xOff + xSize])
+    # Create a mask that invalidates cloudy/zero-alpha pixels
+    valid = np.logical_and(stack[:, 6] > 0, np.logical_not(clouds[:, yOff:yOff + ySize, xOff:xOff + xSize]))
+    indices = {}
+    if indexPath is not None:
+        indices["source"] = indexSource(openIndexCache(indexPath), data, labels, range(len(labels)), window, stack)
+    # Distances to clouds are measured over the whole scene, not just the window
+    indices["cloudSource"] = functools.partial(cloudDistanceWindow, clouds, window)
+    return window, [function(stack, valid, indices) for function in functions]
+
+
+# Function to split the scene grid into windows of at most windowSize x windowSize pixels
+def makeWindows(width, height, windowSize):
+    return [(xOff, yOff, min(windowSize, width - xOff), min(windowSize, height - yOff))
+            for yOff in range(0, height, windowSize) for xOff in range(0, width, windowSize)]
+
+
+# Function to create any subset of the composites in a single pass over the temporal cube
+#   The cube is split into windows that are dispatched to a pool of worker processes, every requested composite is
+#   computed from each window, and finished windows are written straight into the output GeoTIFFs
+#   Each pixel only depends on its own time series, so the output is identical for any number of workers
+#   windowSize is also the GeoTIFF tile size, so it must be a multiple of 16
+#   indexPath -> quality indices are read from (or added to) the persisted spectral index layer in indexPath
+def makeComposites(cubePath, path, composites=tuple(compositeFunctions), windowSize=128, workers=None,
+                   indexPath=None):
+    print("Creating " + ", ".join(composites) + " Composites...")
+    data, labels, geoTransform, projection = openCube(cubePath)
+    _, bands, height, width = data.shape
+    if indexPath is not None:
+        fillIndexLayer(indexPath, data, labels, sorted(set().union(*(compositeIndices.get(name, ())
+                                                                     for name in composites))))
+    names = [os.path.join(path, compositeFunctions[name][1]) for name in composites]
+    functions = [compositeFunctions[name][0] for name in composites]
+    tifs = [createTif(name, width, height, bands, geoTransform, projection, windowSize) for name in names]
+    windows = makeWindows(width, height, windowSize)
+
+    if workers == 1:
+        for window in windows:
+            writeWindow(tifs, *compositeWindow(cubePath, functions, window, indexPath))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(compositeWindow, cubePath, functions, window, indexPath) for window in windows]
+            for future in concurrent.futures.as_completed(futures):
+                writeWindow(tifs, *future.result())
+
+    # Each dataset is released before its temporary GeoTIFF is removed (an open file cannot be removed on Windows)
+    for i, name in enumerate(names):
+        closeTif(tifs[i], name)
+        tifs[i] = None
+        os.remove(tmpTifName(name))
+
+
+# Function to write one finished window of every composite into its GeoTIFF
+def writeWindow(tifs, window, blocks):
+    xOff, yOff, _, _ = window
+    for tif, block in zip(tifs, blocks):
+        writeTifBlock(tif, block, xOff, yOff)
+
+
+# Incremental composites keep a persisted state that new scenes are folded into one at a time
+#   Each fold function takes one block of the state, one block of a new scene, and whether it is the archive's first
+#   image: [band, rows, width]
+#   valid: [rows, width] (alpha-valid and cloudless)
+#   Folding scenes in cube order gives exactly the same values as the full composite functions
+
+# Function to fold a scene into the Mean composite state (running sum and count of valid values)
+def foldMean(state, image, valid, indices, first):
+    np.add(state["sum"], image, out=state["sum"], where=valid)
+    state["count"] += valid
+
+
+def finishMean(state):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return state["sum"] / state["count"]
+
+
+# Function to fold a scene into the Min composite state
+def foldMin(state, image, valid, indices, first):
+    np.minimum(state["min"], image, out=state["min"], where=valid)
+
+
+# Function to fold a scene into the Max composite state
+def foldMax(state, image, valid, indices, first):
+    np.maximum(state["max"], image, out=state["max"], where=valid)
+
+
+# Function to fold a scene into a (max) quality mosaic state (best index value and its value "packet")
+#   Only a strictly better value replaces the packet, so the first scene wins ties as with np.argmax
+def foldQualityMosaic(state, image, valid, indices, first, index="NDVI"):
+    quality = np.where(valid, blockIndex(indices, index, image[np.newaxis])[0], -np.inf)
+    better = np.logical_or(first, quality > state["best"])
+    state["best"][better] = quality[better]
+    state["packet"][:, better] = image[:, better]
+
+
+# Available incremental composites as name -> ({state array: (dtype, per band, initial value)}, fold, finish)
+#   Order statistics (median, percentiles, greenest85) need every observation of a pixel, so an exact state would be
+#   as large as the cube itself, and they are recomputed from the cube instead
+incrementalComposites = {
+    "mean": ({"sum": (np.float64, True, 0), "count": (np.int64, False, 0)}, foldMean, finishMean),
+    "min": ({"min": (np.int64, True, 16384)}, foldMin, lambda state: state["min"]),
+    "max": ({"max": (np.float64, True, 0)}, foldMax, lambda state: state["max"]),
+    "greenest": ({"best": (np.float64, False, -np.inf), "packet": (np.uint16, True, 0)},
+                 functools.partial(foldQualityMosaic, index="NDVI"), lambda state: state["packet"]),
+}
+
+
+# Function to get the file of one array of one generation of an incremental composite's state
+def stateFile(statePath, name, array, generation):
+    return os.path.join(statePath, name + "_" + array + "_" + str(generation) + ".npy")
+
+
+# Function to open one generation of the persisted state of an incremental composite as memory maps
+#   previous -> None creates the generation from the initial values, another generation copies it (so folding never
+#   touches the state state.json points to), and the same generation opens it as is
+def openState(statePath, name, bands, height, width, generation, previous=None):
+    state = {}
+    for array, (dtype, perBand, initial) in incrementalComposites[name][0].items():
+        file = stateFile(statePath, name, array, generation)
+        shape = (bands, height, width) if perBand else (height, width)
+        if previous is None:
+            state[array] = np.lib.format.open_memmap(file, mode='w+', dtype=dtype, shape=shape)
+            state[array][:] = initial
+        else:
+            if previous != generation:
+                shutil.copyfile(stateFile(statePath, name, array, previous), file)
+            state[array] = np.load(file, mmap_mode='r+')
+    return state
+
+
+# Function to update composites with the scenes added to the cube since the last update
+#   Incremental composites fold each new scene into their state in composites/state, at a cost of one scene per new
+#   scene, and are rewritten from the state; the other composites are recomputed from the cube
+#   The first update folds every scene, so the output always matches makeComposites
+#   Scenes are folded into a new generation of the state, which state.json only points to once it is flushed, so an
+#   interrupted update leaves the previous state intact and is simply re-run
+#   State is tied to the cube's build id, so a rebuilt cube (see buildCube) is folded again from its first scene
+#   indexCache -> quality indices are shared through the spectral index layer (see emptyIndexCache)
+def updateComposites(cubePath, path, composites=tuple(compositeFunctions), blockRows=64, workers=None,
+                     indexCache=None):
+    print("Updating Composites...")
+    data, labels, geoTransform, projection = openCube(cubePath)
+    clouds = openCloudMask(cubePath, data.shape)
+    scenes, bands, height, width = data.shape
+    statePath = os.path.join(path, "state")
+    os.makedirs(statePath, exist_ok=True)
+    metaFile = os.path.join(statePath, "state.json")
+    # Composite name -> {"scenes": scenes folded, "generation": current state generation, "build": cube build id}
+    done = {}
+    if os.path.exists(metaFile):
+        with open(metaFile) as jsonFile:
+            done = json.load(jsonFile)
+
+    incremental = [name for name in composites if name in incrementalComposites]
+    build = readCubeMeta(cubePath)["build"]
+    # Scenes are folded one at a time, so the layer only needs room for the planes of one scene (see rankScenes)
+    foldIndices = set().union(*(compositeIndices.get(name, ()) for name in incremental))
+    foldCache = indexCache if indexCache is not None and indexLayerFits(indexCache, data.shape, foldIndices) else None
+    states = {}
+    folded = {}
+    generations = {}
+    for name in incremental:
+        previous = done[name]["generation"] if name in done else None
+        # State folded from an earlier build of the cube (whose scenes have since changed) is started over
+        stale = name in done and done[name].get("build") != build
+        folded[name] = done[name]["scenes"] if name in done and not stale else 0
+        generations[name] = previous if folded[name] == scenes else (-1 if previous is None else previous) + 1
+        states[name] = openState(statePath, name, bands, height, width, generations[name],
+                                 None if stale else previous)
+
+    for i in range(min([folded[name] for name in incremental] + [scenes]), scenes):
+        print("Folding Scene " + str(i + 1) + "/" + str(scenes) + "...")
+        for start in range(0, height, blockRows):
+            stop = min(start + blockRows, height)
+            image = np.array(data[i, :, start:stop, :])
+            # Create a mask that invalidates cloudy/zero-alpha pixels
+            valid = np.logical_and(image[6] > 0, np.logical_not(clouds[i, start:stop, :]))
+            indices = {}
+            if foldCache is not None:
+                indices["source"] = indexSource(foldCache, data, labels, [i], (0, start, width, stop - start),
+                                                exact=True)
+            for name in incremental:
+                if folded[name] <= i:
+                    block = {array: values[..., start:stop, :] for array, values in states[name].items()}
+                    incrementalComposites[name][1](block, image, valid, indices, i == 0)
+
+    previous = {name: done[name]["generation"] for name in incremental if name in done}
+    for name in incremental:
+        for values in states[name].values():
+            values.flush()
+        done[name] = {"scenes": scenes, "generation": generations[name], "build": build}
+    writeJson(metaFile, done)
+    for name, generation in previous.items():
+        if generation != generations[name]:
+            for array in incrementalComposites[name][0]:
+                os.remove(stateFile(statePath, name, array, generation))
+
+    for name in incremental:
+        tifName = os.path.join(path, compositeFunctions[name][1])
+        tif = createTif(tifName, width, height, bands, geoTransform, projection)
+        for start in range(0, height, blockRows):
+            stop = min(start + blockRows, height)
+            block = {array: values[..., start:stop, :] for array, values in states[name].items()}
+            writeTifBlock(tif, incrementalComposites[name][2](block), 0, start)
+        closeTif(tif, tifName)
+        tif = None
+        os.remove(tmpTifName(tifName))
+
+    recompute = [name for name in composites if name not in incrementalComposites]
+    if recompute:
+        makeComposites(cubePath, path, recompute, workers=workers,
+                       indexPath=None if indexCache is None else indexCache["indexPath"])
+
+
+# Function to pick the best compression the GDAL build supports for a driver (ZSTD if available, else DEFLATE)
+def bestCompression(driverName):
+    options = gdal.GetDriverByName(driverName).GetMetadataItem('DMD_CREATIONOPTIONLIST') or ''
+    return 'ZSTD' if 'ZSTD' in options else 'DEFLATE'
+
+
+# Function to get the name of the temporary tiled GeoTIFF a composite is written to before it becomes a COG
+def tmpTifName(name):
+    return name + ".tmp.tif"
+
+
+# Abstract function to create an empty GeoTIFF composite to be written block by block
+#   Blocks are written to a tiled, compressed temporary GeoTIFF (tiles match the composite windows so each tile is
+#   only compressed once), which closeTif turns into a Cloud-Optimized GeoTIFF
+#   Float32 GeoTIFFs (e.g. regression coefficients) use the floating point predictor and NaN as nodata
+def createTif(name, width, height, bands, geoTransform, projection, tileSize=128, dataType=gdal.GDT_UInt16):
     driver = gdal.GetDriverByName('GTiff')
-    tif = driver.Create(name, width, height, bands, gdal.GDT_UInt16)
+    floating = dataType == gdal.GDT_Float32
+    options = ['TILED=YES', 'BLOCKXSIZE=' + str(tileSize), 'BLOCKYSIZE=' + str(tileSize),
+               'COMPRESS=' + bestCompression('GTiff'), 'PREDICTOR=' + ('3' if floating else '2'),
+               'NUM_THREADS=ALL_CPUS', 'BIGTIFF=IF_SAFER']
+    tif = driver.Create(tmpTifName(name), width, height, bands, dataType, options=options)
     tif.SetGeoTransform(geoTransform)
     tif.SetProjection(projection)
-    for band in range(bands):
-        tif.GetRasterBand(band + 1).WriteArray(data[band, :, :])
+    if floating:
+        for band in range(bands):
+            tif.GetRasterBand(band + 1).SetNoDataValue(float('nan'))
+    return tif
+
+
+# Function to convert a block of a composite to the output data type explicitly
+#   Rounds half up (as GDAL does when writing floats to integer bands), clips to the range of the type, and writes
+#   NaN (no valid observations) as 0
+#   Float types are written as they are (NaN is their nodata value)
+def castOutput(data, dtype=np.uint16):
+    if np.issubdtype(dtype, np.floating):
+        return data.astype(dtype)
+    limits = np.iinfo(dtype)
+    if np.issubdtype(data.dtype, np.floating):
+        data = np.nan_to_num(np.floor(data + .5), nan=0)
+    return np.clip(data, limits.min, limits.max).astype(dtype)
+
+
+# Function to write a block of a composite into a GeoTIFF
+def writeTifBlock(tif, data, xOff, yOff, dtype=np.uint16):
+    data = castOutput(data, dtype)
+    for band in range(tif.RasterCount):
+        tif.GetRasterBand(band + 1).WriteArray(data[band, :, :], xOff, yOff)
+
+
+# Function to flush a GeoTIFF composite and write it out as a Cloud-Optimized GeoTIFF
+#   (tiled, compressed with a predictor, internal overviews, multithreaded compression)
+#   The caller removes the temporary GeoTIFF once it has released the dataset
+def closeTif(tif, name):
     tif.FlushCache()
-    tif = None
+    options = ['COMPRESS=' + bestCompression('COG'), 'PREDICTOR=YES', 'NUM_THREADS=ALL_CPUS', 'BIGTIFF=IF_SAFER',
+               'RESAMPLING=AVERAGE']
+    gdal.Translate(name, tif, format='COG', creationOptions=options)
     print("Done, Output: " + name)
 
 
 # Main execution to complete task 2
 if __name__ == "__main__":
-    images, labels, geoTransform, projection = loadImages(GeoTIF_dir)
-    createHistogram(images)
-    images = createCloudMask(images)
-
-    findGreenest(images, labels)
-    findSnowiest(images, labels)
-    findCloudiest(images, labels)
-    findBrightest(images, labels)
-
-    # Create necessary directory
-    try:
-        os.mkdir(composites_dir)
-    except:
-        sys.exit("Task 2 Composites already exist")
-
-    makeMean(images, composites_dir, geoTransform, projection)
-    makeMin(images, composites_dir, geoTransform, projection)
-    makeMax(images, composites_dir, geoTransform, projection)
-    makeMedian(images, composites_dir, geoTransform, projection)
-    makeGreenest(images, composites_dir, geoTransform, projection)
-    make85Greenest(images, composites_dir, geoTransform, projection)
+    images, labels, geoTransform, projection = loadImages(GeoTIF_dir, cube_dir)
+    createHistogram(cube_dir)
+    clouds = loadCloudMask(cube_dir, images)
+    # Bands are read from the cube once for the rankings and the spectral indices
+    blockCache = emptyBlockCache()
+    # NDVI/NDSI are computed once per scene and shared by the rankings and composites
+    indexCache = emptyIndexCache(blockCache=blockCache)
+
+    findSuperlatives(images, clouds, labels, cache=blockCache, indexCache=indexCache)
+
+    # Create necessary directory (existing composites are updated with the scenes added since the last run)
+    os.makedirs(composites_dir, exist_ok=True)
+    updateComposites(cube_dir, composites_dir, indexCache=indexCache)
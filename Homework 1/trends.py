@@ -0,0 +1,155 @@
+import os
+import re
+import sys
+import datetime
+import concurrent.futures
+import numpy as np
+from osgeo import gdal
+import task_2
+
+## Per-pixel time series regression over the Spatially Aligned archive loaded by task_2
+##   Every pixel's NDVI/NDSI series (valid, cloudless observations only) is fit with a harmonic model
+##     value = intercept + slope * t + c * cos(2 pi t) + s * sin(2 pi t)    (t in years)
+##   and tested for a change point with an OLS-CUSUM test of its residuals
+
+# Defining relative PATHs
+trends_dir = "trends"
+
+# Bands of each output GeoTIFF (one per index)
+#   intercept: value at Jan 1 of the first year, slope: change per year, amplitude: seasonal amplitude,
+#   peakDay: day of year of the seasonal peak, rmse: residual error, observations: number of valid observations,
+#   cusum: OLS-CUSUM statistic, change: 1 if the statistic is significant at 5% (> 1.358), changeYear: decimal year of
+#   the largest cumulative residual (where the series departs most from the model)
+trendBands = ("intercept", "slope", "amplitude", "peakDay", "rmse", "observations", "cusum", "change", "changeYear")
+
+
+# Function to get the acquisition date of a scene from its filename (e.g. sentinel-2_L1C_2018-09-04.tif), or from its
+# TIFF metadata if the filename has no date
+def sceneDate(label):
+    match = re.search(r"(\d{4})-(\d{2})-(\d{2})", os.path.basename(label))
+    if match:
+        return datetime.date(*(int(part) for part in match.groups()))
+    stamp = gdal.Open(label).GetMetadataItem('TIFFTAG_DATETIME')
+    if stamp is None:
+        sys.exit("No acquisition date for " + label)
+    return datetime.datetime.strptime(stamp, "%Y:%m:%d %H:%M:%S").date()
+
+
+# Function to convert (irregular) acquisition dates to years since Jan 1 of the first year
+def decimalYears(dates):
+    origin = datetime.date(min(dates).year, 1, 1)
+    return np.array([(date - origin).days / 365.25 for date in dates])
+
+
+# Function to build the harmonic model's design matrix -> [scene, 4]
+def designMatrix(t):
+    return np.stack([np.ones_like(t), t, np.cos(2 * np.pi * t), np.sin(2 * np.pi * t)], axis=1)
+
+
+# Function to fit the harmonic model to every pixel of a block at once by weighted least squares
+#   X: [scene, 4]
+#   values: [scene, pixels]
+#   valid: [scene, pixels]
+#   Each pixel's normal equations (X^T W X) beta = X^T W y are built with matrix products over the scenes and solved
+#   with a batched pseudo-inverse, so pixels with too few observations never stop the batch
+#   Pixels with fewer than minObservations valid observations get NaN coefficients
+def fitHarmonic(X, values, valid, minObservations=6):
+    scenes, terms = X.shape
+    weight = valid.astype(np.float64)
+    outer = (X[:, :, np.newaxis] * X[:, np.newaxis, :]).reshape(scenes, terms * terms)
+    gram = (weight.T @ outer).reshape(-1, terms, terms)
+    moment = np.where(valid, values, 0).T @ X
+    beta = np.einsum('npq,nq->np', np.linalg.pinv(gram), moment)
+    count = np.count_nonzero(valid, axis=0)
+    beta[count < minObservations] = np.nan
+    return beta, count
+
+
+# Function to compute the trend rasters of one index over a block -> [trend band, pixels]
+#   t: [scene] (years since Jan 1 of firstYear, in time order), values: [scene, pixels], valid: [scene, pixels]
+def trendBlock(t, firstYear, values, valid, minObservations=6):
+    X = designMatrix(t)
+    beta, count = fitHarmonic(X, values, valid, minObservations)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        residuals = np.where(valid, values - X @ beta.T, 0)
+        rmse = np.sqrt(np.sum(np.square(residuals), axis=0) / (count - X.shape[1]))
+        # OLS-CUSUM: largest cumulative residual, relative to what a stable series would give
+        cumulative = np.abs(np.cumsum(residuals, axis=0))
+        cusum = np.max(cumulative, axis=0) / (rmse * np.sqrt(count))
+        changeYear = firstYear + t[np.argmax(cumulative, axis=0)]
+        peakDay = np.mod(np.arctan2(beta[:, 3], beta[:, 2]) / (2 * np.pi), 1) * 365.25
+
+    trends = np.stack([beta[:, 0], beta[:, 1], np.hypot(beta[:, 2], beta[:, 3]), peakDay, rmse, count, cusum,
+                       cusum > 1.358, changeYear])
+    # Pixels without a fit keep their number of valid observations, every other band is NaN
+    fitted = np.arange(len(trendBands)) != trendBands.index("observations")
+    trends[np.ix_(fitted, np.isnan(beta[:, 0]))] = np.nan
+    return trends
+
+
+# Function to compute the trend rasters of every index for one window of the cube (run in worker processes)
+#   t: [scene] years of the cube's scenes (in cube order) since Jan 1 of firstYear
+#   window: (xOff, yOff, xSize, ySize)
+def trendWindow(cubePath, names, t, firstYear, window):
+    data, clouds, _ = task_2.openWindowSource(cubePath)
+    xOff, yOff, xSize, ySize = window
+    order = np.argsort(t, kind='stable')
+    stack = np.array(data[:, :, yOff:yOff + ySize, xOff:xOff + xSize])[order]
+    valid = np.logical_and(stack[:, 6] > 0, np.logical_not(clouds[order, yOff:yOff + ySize, xOff:xOff + xSize]))
+    blocks = []
+    for name, values in task_2.blockIndices(stack, names).items():
+        values = values.reshape(len(t), -1)
+        ok = valid.reshape(len(t), -1) & np.isfinite(values)
+        blocks.append(trendBlock(t[order], firstYear, values, ok).reshape(len(trendBands), ySize, xSize))
+    return window, blocks
+
+
+# Function to fit the trends of some spectral indices over the whole (cloud masked) cube, window by window in a pool of
+# worker processes, and write them as one Float32 GeoTIFF per index (e.g. trends/NDVI.tif)
+def fitTrends(cubePath, path, names=("NDVI", "NDSI"), windowSize=128, workers=None):
+    print("Fitting " + ", ".join(names) + " Trends...")
+    data, labels, geoTransform, projection = task_2.openCube(cubePath)
+    _, _, height, width = data.shape
+    dates = [sceneDate(label) for label in labels]
+    t = decimalYears(dates)
+    firstYear = min(dates).year
+    tifNames = [os.path.join(path, name + ".tif") for name in names]
+    tifs = [task_2.createTif(name, width, height, len(trendBands), geoTransform, projection, windowSize,
+                             gdal.GDT_Float32) for name in tifNames]
+    for tif in tifs:
+        for band, description in enumerate(trendBands):
+            tif.GetRasterBand(band + 1).SetDescription(description)
+    # The loop variable is released too, so only tifs holds the datasets when they are closed and removed below
+    tif = None
+    windows = task_2.makeWindows(width, height, windowSize)
+
+    if workers == 1:
+        for window in windows:
+            writeTrendWindow(tifs, *trendWindow(cubePath, names, t, firstYear, window))
+    else:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(trendWindow, cubePath, names, t, firstYear, window) for window in windows]
+            for future in concurrent.futures.as_completed(futures):
+                writeTrendWindow(tifs, *future.result())
+
+    # Each dataset is released before its temporary GeoTIFF is removed (an open file cannot be removed on Windows)
+    for i, name in enumerate(tifNames):
+        task_2.closeTif(tifs[i], name)
+        tifs[i] = None
+        os.remove(task_2.tmpTifName(name))
+
+
+# Function to write one finished window of every index's trends into its GeoTIFF
+def writeTrendWindow(tifs, window, blocks):
+    xOff, yOff, _, _ = window
+    for tif, block in zip(tifs, blocks):
+        task_2.writeTifBlock(tif, block, xOff, yOff, np.float32)
+
+
+# Main execution
+if __name__ == "__main__":
+    images, labels, geoTransform, projection = task_2.loadImages(task_2.GeoTIF_dir, task_2.cube_dir)
+    task_2.loadCloudMask(task_2.cube_dir, images)
+
+    os.makedirs(trends_dir, exist_ok=True)
+    fitTrends(task_2.cube_dir, trends_dir)
@@ -72,6 +72,7 @@ Every model will be scored against a test set that I have that you do not have a
 # base imports
 from glob import glob
 import itertools
+import json
 import matplotlib
 import matplotlib.pyplot as plt
 # %matplotlib inline
@@ -103,6 +104,9 @@ df.head(5)
 image_base = 'super_secret_images_link'
 target_base = 'super_secret_targets_link'
 
+# the Task 1 statistics are saved here, so Task 2 can load them without rescanning the dataset
+stats_file = 'dataset_stats.json'
+
 # load in file links from cloud storage
 samples = list()
 for idx, row in df.iterrows():
@@ -163,6 +167,12 @@ nlcd_name_mapping = {
     95: 'Emergent Herbaceous Wetlands',
 }
 
+# lookup table from raw NLCD values to their index in the NLCD color scheme
+# (values outside the scheme map to 0)
+nlcd_index_lut = np.zeros(256, dtype=np.uint8)
+for class_val, nlcd_val in enumerate(nlcd_color_mapping.keys()):
+  nlcd_index_lut[nlcd_val] = class_val
+
 # build a matplotlib colormap so we can visualize this data
 colors = list()
 for idx, class_val in enumerate(nlcd_color_mapping.keys()):
@@ -216,9 +226,8 @@ def read_sample(data_path: str) -> tuple:
   with rasterio.open(target_path) as src:
     tgt = np.transpose(src.read(), axes=(1, 2, 0)).astype(np.uint8)
 
-  tgt_out = np.zeros(tgt.shape, dtype=np.uint8)
-  for class_val, nlcd_val in enumerate(nlcd_color_mapping.keys()):
-    tgt_out[tgt == nlcd_val] = class_val
+  # single gather instead of a comparison per class
+  tgt_out = nlcd_index_lut[tgt]
 
   return (img, tgt_out)
 
@@ -311,6 +320,12 @@ nlcd_to_new = {
     15: 8
 }
 
+# lookup tables to remap with a single gather instead of a python call per pixel
+# index_to_new: NLCD color scheme index (as returned by read_sample) -> new class
+# nlcd_lut: raw NLCD value -> new class
+index_to_new = np.array([nlcd_to_new[i] for i in range(len(nlcd_to_new))], dtype=np.uint8)
+nlcd_lut = index_to_new[nlcd_index_lut]
+
 # shorter set of RGB values for classes
 new_color_mapping = [
     [70, 107, 159],
@@ -415,10 +430,55 @@ cmap = matplotlib.colors.ListedColormap(colors=colors, N=len(colors))
 bounds = list(range(len(colors)))
 norm = matplotlib.colors.BoundaryNorm(bounds, len(colors))
 
-for ind, (x, y) in enumerate(ds):
+import concurrent.futures
+
+# single pass statistics engine: every sample is read once (in parallel threads,
+# since reading from cloud storage is mostly waiting) and reduced to a small summary,
+# everything in Task 1 (and the normalization in Task 2) is then computed from the
+# summaries, so changing the invalid threshold never needs another pass over the data
+
+# per-band count, mean and sum of squared deviations (M2) of an image
+def band_moments(img):
+  values = img.reshape(-1, img.shape[-1]).astype(np.float64)
+  mean = values.mean(axis=0)
+  return (values.shape[0], mean, np.square(values - mean).sum(axis=0))
+
+# merge two sets of band moments (Chan et al. parallel form of Welford's algorithm)
+# exact for any split of the data, so summaries can be merged in any order
+def merge_moments(a, b):
+  n_a, mean_a, m2_a = a
+  n_b, mean_b, m2_b = b
+  n = n_a + n_b
+  if n == 0:
+    return a
+  delta = mean_b - mean_a
+  return (n, mean_a + delta * n_b / n, m2_a + m2_b + np.square(delta) * n_a * n_b / n)
+
+# summary of one sample: invalid pixels, new class counts and band moments
+def sample_summary(image_file, target_file):
+  with rasterio.open(image_file) as src:
+    img = np.transpose(src.read(), axes=(1, 2, 0))
+  with rasterio.open(target_file) as src:
+    tgt = src.read(1).astype(np.uint8)
+
+  return {
+      'alpha': int(np.count_nonzero(img[:, :, 9] == 0)),
+      'cloud': int(np.count_nonzero(img[:, :, 8] > 0)),
+      'classes': np.bincount(nlcd_lut[tgt].ravel(), minlength=9),
+      'moments': band_moments(img[:, :, :8]),
+  }
+
+# summaries of all the samples, in the same order as samples
+def dataset_summaries(samples, workers=16):
+  with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+    return list(executor.map(lambda sample: sample_summary(*sample), samples))
+
+summaries = dataset_summaries(samples)
+
+for ind, summary in enumerate(summaries):
   # gets information on invalid pixels
-  alpha_pixels = np.count_nonzero(x[:, :, 9] == 0)
-  cloud_pixels = np.count_nonzero(x[:, :, 8] > 0)
+  alpha_pixels = summary['alpha']
+  cloud_pixels = summary['cloud']
   invalid_pixels['alpha'] += alpha_pixels
   invalid_pixels['cloud'] += cloud_pixels
   if alpha_pixels > 0 and cloud_pixels > 0:
@@ -431,16 +491,13 @@ for ind, (x, y) in enumerate(ds):
     invalid_images['cloud'] += 1
     percentages_of_invalid[ind] = (cloud_pixels) / (256*256)
 
-  # map output classes from standard NLCD to new classes
-  y = np.vectorize(nlcd_to_new.get)(y)
-  # get unique counts of each class
-  counts = dict(zip(*np.unique(y, return_counts=True)))
+  # counts of each new class
+  counts = summary['classes']
   classes_in_image[ind] = []
   for i in range(9):
-    if i in counts:
-      tot_counts[i] += counts[i]
+    if counts[i] > 0:
+      tot_counts[i] += int(counts[i])
       classes_in_image[ind].append(i)
-  #print(ind)
 
 # gives idea of how much information will need to be tossed
 invalid_pixels
@@ -474,36 +531,38 @@ num_of_invalid
 # get information on valid images based on threshold
 # making sure an individual class isnt too strongly effected by tossing data
 # used to help determine threshold
-for ind, (x, y) in enumerate(ds):
+# (band moments of the valid images are merged along the way, no rescan needed)
+valid_moments = (0, np.zeros(8), np.zeros(8))
+for ind, summary in enumerate(summaries):
   if ind in percentages_of_invalid and percentages_of_invalid[ind] >= invalid_percent_thres:
     continue
-  # map output classes from standard NLCD to new classes
-  y = np.vectorize(nlcd_to_new.get)(y)
-  # get unique counts of each class
-  counts = dict(zip(*np.unique(y, return_counts=True)))
   for i in range(9):
-    if i in counts:
-      new_counts[i] += counts[i]
-  # store a sum of all the values in a band for computation later
-  for i in range(8):
-    means[i] += np.sum(x[:, :, i], dtype=np.int64)
-  #print(ind)
-
-# calculate the actual means from sums
-for band, sum in means.items():
-  means[band] = sum / ((len(samples) - num_of_invalid) * 256 * 256)
-
-# iterate through data again to get the values necessary for standard deviation
-# calculation
-for x, y in ds:
-  if ind in percentages_of_invalid and percentages_of_invalid[ind] >= invalid_percent_thres:
-    continue
-  for i in range(8):
-    stds[i] += np.sum(np.square(x[:, :, i] - means[i]), dtype=np.int64)
-
-# calculate the actual (sample) standard deviations from sums
-for band, sum in stds.items():
-  stds[band] = np.sqrt(sum / ((len(samples) - num_of_invalid) * 256 * 256 - 1))
+    new_counts[i] += int(summary['classes'][i])
+  valid_moments = merge_moments(valid_moments, summary['moments'])
+
+# means and (sample) standard deviations of each band over the valid images
+count, band_means, band_m2 = valid_moments
+for band in range(8):
+  means[band] = band_means[band]
+  stds[band] = np.sqrt(band_m2[band] / (count - 1))
+
+# save the statistics so training can load them without rescanning the dataset
+with open(stats_file, 'w') as f:
+  json.dump({
+      'invalid_percent_thres': invalid_percent_thres,
+      'means': means,
+      'stds': stds,
+      'tot_counts': tot_counts,
+      'new_counts': new_counts,
+      'invalid_pixels': invalid_pixels,
+      'invalid_images': invalid_images,
+      'percentages_of_invalid': percentages_of_invalid,
+      'classes_in_image': classes_in_image,
+      'samples': [{'alpha': summary['alpha'],
+                   'cloud': summary['cloud'],
+                   'classes': summary['classes'].tolist(),
+                   'means': summary['moments'][1].tolist()} for summary in summaries],
+  }, f)
 
 # look at mean values of bands across dataset
 means
@@ -559,6 +618,16 @@ plt.show()
 
 """### Task 2"""
 
+# load the Task 1 statistics (e.g. in a fresh runtime) instead of rescanning the dataset
+# json keys are strings, so convert them back to ints
+with open(stats_file) as f:
+  stats = json.load(f)
+means = {int(band): value for band, value in stats['means'].items()}
+stds = {int(band): value for band, value in stats['stds'].items()}
+percentages_of_invalid = {int(ind): value for ind, value in stats['percentages_of_invalid'].items()}
+new_counts = {int(k): v for k, v in stats['new_counts'].items()}
+invalid_percent_thres = stats['invalid_percent_thres']
+
 # create a new list to create a new TF Dataset, eliminating invalid images
 new_samples = []
 for ind, (image_file, target_file) in enumerate(samples):
@@ -574,6 +643,24 @@ for ind, (image_file, target_file) in enumerate(samples):
 
 import sys
 
+# band math engine from Homework 1 (upload bandMath.py next to this notebook)
+# the extra indices are declared once and evaluated in one pass over an image
+import bandMath
+
+# [coastal-aerosol, blue, green, red, nir, swir1, swir2, tirs1, cloud-mask, alpha]
+landsat_bands = {'ca': 0, 'b': 1, 'g': 2, 'r': 3, 'n': 4, 's1': 5, 's2': 6, 't1': 7}
+
+# https://www.usna.edu/Users/oceano/pguth/md_help/html/norm_sat.htm
+# https://pro.arcgis.com/en/pro-app/latest/arcpy/spatial-analyst/ndbi.htm
+extra_indices = bandMath.compileIndices({
+    'NDWI': '(g - n) / (g + n + eps)',
+    'NDVI': '(n - r) / (n + r + eps)',
+    # NDSI (Snow)
+    'NDSI': '(g - s1) / (g + s1 + eps)',
+    # NDSI (Soil) / NDBI
+    'NDBI': '(s1 - n) / (s1 + n + eps)',
+}, landsat_bands, {'eps': sys.float_info.epsilon})
+
 # function to normalize pixel values
 # ideally want all pixel values to be on the same order of magnitude
 # originally used a simple min/max scaling to normalize between -1 and 1
@@ -593,17 +680,9 @@ def read_and_preprocess(data_path: str) -> tuple:
     img = np.transpose(src.read(), axes=(1, 2, 0)).astype(np.int32)
 
   # add additional band information to help model
+  # (NDWI, NDVI, NDSI, NDBI evaluated together, straight into the last 4 bands)
   new_img = np.zeros((256, 256, 12))
-  # https://www.usna.edu/Users/oceano/pguth/md_help/html/norm_sat.htm
-  # NDWI
-  new_img[:, :, 8] = (img[:, :, 2] - img[:, :, 4]) / (img[:, :, 2] + img[:, :, 4] + sys.float_info.epsilon)
-  # NDVI
-  new_img[:, :, 9] = (img[:, :, 4] - img[:, :, 3]) / (img[:, :, 4] + img[:, :, 3] + sys.float_info.epsilon)
-  # NDSI (Snow)
-  new_img[:, :, 10] = (img[:, :, 2] - img[:, :, 5]) / (img[:, :, 2] + img[:, :, 5] + sys.float_info.epsilon)
-  # NDSI (Soil) / NDBI
-  # https://pro.arcgis.com/en/pro-app/latest/arcpy/spatial-analyst/ndbi.htm
-  new_img[:, :, 11] = (img[:, :, 5] - img[:, :, 4]) / (img[:, :, 5] + img[:, :, 4] + sys.float_info.epsilon)
+  bandMath.evaluateIndices(extra_indices, img, axis=2, out=np.moveaxis(new_img[:, :, 8:], 2, 0))
   # normalize all the bands except for cloud and alpha since not used in the model
   for i in range(8):
     new_img[:, :, i] = normalize_band(img[:, :, i], i)
@@ -611,12 +690,8 @@ def read_and_preprocess(data_path: str) -> tuple:
   with rasterio.open(target_path) as src:
     tgt = np.transpose(src.read(), axes=(1, 2, 0)).astype(np.uint8)
 
-  tgt_out = np.zeros(tgt.shape, dtype=np.uint8)
-  for class_val, nlcd_val in enumerate(nlcd_color_mapping.keys()):
-    tgt_out[tgt == nlcd_val] = class_val
-
-  # map output classes from standard NLCD to new classes
-  tgt_out = np.vectorize(nlcd_to_new.get)(tgt_out)
+  # map output classes straight from raw NLCD values to new classes
+  tgt_out = nlcd_lut[tgt]
 
   return (new_img, tgt_out)
 